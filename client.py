@@ -12,13 +12,46 @@ client.py
     A client to connect to server.py and run commands through. Provides the user with a simple command line interface.
 
     Can change the HOST to be match the host ip address of the server's machine
+
+    Asks the server for the binary protocol (v2) after connecting, and falls back to the
+    line based protocol (v1) when talking to a server that does not know it.
 """
 
 import socket
+import struct
 import os
+import hashlib
+import zlib
+import lzma
+import mimetypes
 
 CHUNK_SIZE = 65536
 
+"""Binary protocol (v2), see server.py"""
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct("!BII")    # opcode, request id, payload length
+FRAME_DATA_SIZE = 262144                # Size of the DATA frames a PUSH is cut into
+COMPRESSION = "zlib"                    # "zlib", "lzma" or None, how PUSH/GET ask for their DATA to be compressed
+COMPRESSION_LEVEL = 6
+# MIME types whose content is compressed already, those files are sent as they are
+COMPRESSED_TYPES = ("image/", "audio/", "video/", "application/zip", "application/gzip", "application/x-7z",
+                    "application/x-rar", "application/java-archive", "application/pdf", "application/vnd.openxmlformats")
+UNCOMPRESSED_TYPES = ("image/svg+xml", "image/bmp", "image/tiff", "audio/x-wav")
+
+class Opcode:
+    LOGIN = 1
+    LIST = 2
+    PUSH = 3
+    GET = 4
+    DELETE = 5
+    DATA = 6
+    READY = 7
+    OK = 8
+    ERROR = 9
+    END = 10
+    STATS = 13
+"""---------"""
+
 #-------------------------------
 #Load the configured Host and Port for server socket to bind to
 HOST = 'localhost'    # The remote host
@@ -38,7 +71,7 @@ COMMANDS = {
     },
     "LIST": {
         "args": 1,
-        "signature": "LIST"
+        "signature": "LIST [<option>=<value> ...]"  # prefix, owner, sort (name/size/time, -size for reverse), limit, cursor
     },
     "GET": {
         "args": 2,
@@ -47,10 +80,16 @@ COMMANDS = {
     "DELETE": {
         "args": 2,
         "signature": "DELETE <filename>"
+    },
+    "STATS": {
+        "args": 1,
+        "signature": "STATS"
     }
 }
 
 loggedIn = False
+protocol = 1
+nextRequestId = 0
 
 def isValidCommand(commandmsg: str) -> tuple[bool, str, str, list]:
     """
@@ -79,9 +118,11 @@ def isValidCommand(commandmsg: str) -> tuple[bool, str, str, list]:
         #Command does not exist
         return False, f"Unknown command: {command}", None, None
     
-    expectedArguments = len(COMMANDS[command]["signature"].split())
+    signature = COMMANDS[command]["signature"].split()
+    expectedArguments = len([token for token in signature if not token.startswith("[") and not token.endswith("]")])
+    takesOptions = signature[-1].endswith("...]")   # optional name=value arguments
 
-    if len(tokens) != expectedArguments:
+    if len(tokens) != expectedArguments and not (takesOptions and len(tokens) > expectedArguments):
         #If the number of tokens does not equal the expected tokens for the command
         signature = COMMANDS[command]["signature"]
         return False, f"{command} expects {expectedArguments-1} argument(s): {signature}", None, None
@@ -128,7 +169,7 @@ def push(clientSocket, filename):
 def get(clientSocket, filename):
     """Client attempts to get a file filename over clientSocket. 
     Client sends command and awaits an okay from the server. 
-    Then server sends the file size, then sends the file as raw bytes."""
+    Then server sends the file size, then streams the file as raw bytes."""
     try:
         # Send the initial command
         clientSocket.sendall(f"GET {filename}\n".encode("utf-8"))
@@ -163,7 +204,6 @@ def get(clientSocket, filename):
                     break
                 f.write(packet)
                 received += len(packet)
-                clientSocket.sendall("CONTINUE\n".encode("utf-8"))
 
         # ping server so it knows we are DONE
         clientSocket.sendall("DONE\n".encode("utf-8"))
@@ -173,6 +213,192 @@ def get(clientSocket, filename):
     except Exception as e:
         print("Error during file get:", e)
 
+def newRequestId():
+    """Returns a request id that has not been used on this connection yet"""
+    global nextRequestId
+    nextRequestId += 1
+    return nextRequestId
+
+def negotiateProtocol(clientSocket):
+    """Asks the server for the binary protocol. Returns the protocol version to talk to the server with"""
+    clientSocket.sendall(f"PROTO {PROTOCOL_VERSION}\n".encode("utf-8"))
+    response = clientSocket.recv(CHUNK_SIZE).decode("utf-8")
+    if response.strip() == f"PROTO {PROTOCOL_VERSION} OK":
+        return PROTOCOL_VERSION
+    return 1    # An older server answers with its login error, it only knows the text protocol
+
+def sendFrame(clientSocket, opcode, requestId, payload=b""):
+    """Sends one v2 frame. A str payload is sent as utf-8"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    clientSocket.sendall(FRAME_HEADER.pack(opcode, requestId, len(payload)) + payload)
+
+def recvExactly(clientSocket, count):
+    """Receives exactly count bytes, straight into one buffer"""
+    data = bytearray(count)
+    view = memoryview(data)
+    received = 0
+    while received < count:
+        got = clientSocket.recv_into(view[received:])
+        if got == 0:
+            raise ConnectionError("Server closed the connection")
+        received += got
+    return data
+
+def recvFrame(clientSocket):
+    """Receives the next v2 frame as (opcode, requestId, payload)"""
+    opcode, requestId, length = FRAME_HEADER.unpack(recvExactly(clientSocket, FRAME_HEADER.size))
+    return opcode, requestId, recvExactly(clientSocket, length)
+
+def request(clientSocket, opcode, payload=""):
+    """Sends a v2 command and returns whether it succeeded along with the server's reply text"""
+    requestId = newRequestId()
+    sendFrame(clientSocket, opcode, requestId, payload)
+    replyOpcode, _, reply = recvFrame(clientSocket)
+    return replyOpcode == Opcode.OK, reply.decode("utf-8")
+
+def isCompressed(filename):
+    """True if filename's type says its content is compressed already, so compressing it again would not pay off"""
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if encoding is not None:
+        return True
+    if mimetype is None:
+        return False
+    return mimetype.startswith(COMPRESSED_TYPES) and not mimetype.startswith(UNCOMPRESSED_TYPES)
+
+def compressionOption():
+    """The option line asking the server to compress a transfer, or "" if COMPRESSION is off"""
+    return f"\ncompress {COMPRESSION} {COMPRESSION_LEVEL}" if COMPRESSION else ""
+
+def readyOptions(reply):
+    """
+    Splits a READY payload into its first line and its option lines as {name: value}, such as the compression
+    method the server agreed to ("compress") and the SHA-256 of the file ("sha256")
+    """
+    first, *lines = reply.decode("utf-8").split("\n")
+    options = {}
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 2:
+            options[tokens[0]] = tokens[1]
+    return first, options
+
+def pushFrames(clientSocket, filename):
+    """
+    v2 push: announce the file with its size, then send it as DATA frames once the server is READY.
+    READY carries the offset to send from, which is past 0 when an earlier push of the file broke off.
+    Unless the file is compressed already, the DATA frames are one compressed stream.
+    The PUSH carries the file's SHA-256, so the server can answer straight away if it has the file already.
+    """
+    try:
+        filesize = os.path.getsize(filename)
+        with open(filename, "rb") as f:
+            checksum = hashlib.file_digest(f, "sha256").hexdigest()
+        requestId = newRequestId()
+        options = f"\nsha256 {checksum}"
+        if not isCompressed(filename):
+            options += compressionOption()
+        sendFrame(clientSocket, Opcode.PUSH, requestId, f"{filesize} {filename}{options}")
+        opcode, _, reply = recvFrame(clientSocket)
+        if opcode == Opcode.OK:     # Already up to date
+            print(reply.decode("utf-8") + "\n")
+            return
+        if opcode != Opcode.READY:
+            print(f"Error: {reply.decode('utf-8')}\n")
+            return
+        offset, readyOpts = readyOptions(reply)
+        method = readyOpts.get("compress")
+        sent = int(offset or 0)
+        if sent:
+            print(f"Resuming upload of {filename} at byte {sent}\n")
+        else:
+            print(f"Uploading file: {filename}\n")
+
+        with open(filename, "rb") as f:
+            if method is not None:
+                compressor = lzma.LZMACompressor(preset=COMPRESSION_LEVEL) if method == "lzma" else zlib.compressobj(COMPRESSION_LEVEL)
+                f.seek(sent)
+                while sent < filesize:
+                    chunk = f.read(min(FRAME_DATA_SIZE, filesize - sent))
+                    if not chunk:
+                        raise ConnectionError(f"{filename} shrank during the upload")
+                    sent += len(chunk)
+                    data = compressor.compress(chunk)
+                    if sent >= filesize:
+                        data += compressor.flush()
+                    if data:
+                        sendFrame(clientSocket, Opcode.DATA, requestId, data)
+            while sent < filesize:
+                count = min(FRAME_DATA_SIZE, filesize - sent)
+                clientSocket.sendall(FRAME_HEADER.pack(Opcode.DATA, requestId, count))
+                clientSocket.sendfile(f, sent, count)    # The kernel copies the file into the socket
+                sent += count
+
+        _, _, reply = recvFrame(clientSocket)
+        print(reply.decode("utf-8") + "\n")
+
+    except Exception as e:
+        print("Error during file push:", e)
+
+def getFrames(clientSocket, filename):
+    """
+    v2 get: the server answers READY with the file size and streams DATA frames until END.
+    The file is received into <filename>.part and renamed once complete. If a .part is already there from a download
+    that broke off, only the rest of the file is asked for.
+    The download is checked against the SHA-256 the server sends with READY, if it has one for the file.
+    """
+    try:
+        partname = os.path.basename(filename) + ".part"
+        offset = os.path.getsize(partname) if os.path.exists(partname) else 0
+        requestId = newRequestId()
+        options = f"\nrange {offset}" if offset else ""
+        sendFrame(clientSocket, Opcode.GET, requestId, filename + options + compressionOption())
+        opcode, _, reply = recvFrame(clientSocket)
+        if opcode != Opcode.READY and offset:
+            # The file on the server no longer matches what was downloaded so far, start over
+            os.remove(partname)
+            getFrames(clientSocket, filename)
+            return
+        if opcode != Opcode.READY:
+            print(f"Error: {reply.decode('utf-8')}\n")
+            return
+        if offset:
+            print(f"Resuming download of {filename} at byte {offset}\n")
+        else:
+            print(f"Downloading file: {filename}\n")
+
+        _, readyOpts = readyOptions(reply)
+        method = readyOpts.get("compress")
+        decompressor = None
+        if method is not None:
+            decompressor = lzma.LZMADecompressor() if method == "lzma" else zlib.decompressobj()
+        with open(partname, "a+b") as f:
+            f.seek(0)
+            checksum = hashlib.file_digest(f, "sha256")   # Covers what an earlier attempt already downloaded
+            while True:
+                opcode, _, payload = recvFrame(clientSocket)
+                if opcode != Opcode.DATA:
+                    break
+                data = decompressor.decompress(payload) if decompressor else payload
+                f.write(data)
+                checksum.update(data)
+        if opcode != Opcode.END:
+            print(f"Error: {payload.decode('utf-8')}\n")
+            return
+        if "sha256" in readyOpts and checksum.hexdigest() != readyOpts["sha256"]:
+            os.remove(partname)
+            print(f"Error: {filename} did not arrive intact (SHA-256 mismatch), please download it again.\n")
+            return
+        os.replace(partname, os.path.basename(filename))
+
+        print(f"File {filename} downloaded.\n")
+        if decompressor is not None:
+            received, wire = payload.decode("utf-8").split()
+            print(f"{received} bytes were sent as {wire}.\n")
+
+    except Exception as e:
+        print("Error during file get:", e)
+
 """
 
 Setup the client socket and loop running commands
@@ -184,12 +410,33 @@ try:
 
     data = clientSocket.recv(CHUNK_SIZE) #receive first message from server
     print(data.decode('utf-8'))
+    protocol = negotiateProtocol(clientSocket)
 
     while True:
         clientInput = input("Enter Command: ")
         valid, message, command, args = isValidCommand(clientInput)
 
-        if valid:   # User sends a valid command
+        if valid and protocol != 1:     # User sends a valid command, sent to the server in frames
+
+            if command == "PUSH" and loggedIn:
+                filename = args[0]
+                if os.path.exists(filename):
+                    pushFrames(clientSocket, filename)
+                else:
+                    print(f"Error: File '{filename}' does not exist in the current directory.\n")
+            elif command == "GET" and loggedIn:
+                getFrames(clientSocket, args[0])
+            elif command == "LIST":
+                # name=value arguments become the option lines of the LIST
+                ok, reply = request(clientSocket, Opcode.LIST, "\n".join(arg.replace("=", " ", 1) for arg in args))
+                print(reply + "\n")
+            else:
+                ok, reply = request(clientSocket, getattr(Opcode, command), " ".join(args))
+                if command == "LOGIN" and ok:
+                    loggedIn = True
+                print(reply + "\n")
+
+        elif valid:   # User sends a valid command
 
             if command == "PUSH" and loggedIn:
                 # Need to check if the file exists
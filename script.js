@@ -60,24 +60,35 @@ function check_login_status() {
    xhr.send()
 }
 
-function list() {
+const LIST_PAGE_SIZE = 200;
+let listCursor = null;
+
+function list(more = false) {
   /*
-  Request the file list from the server,
-  creates a table of files to display on the webpage
+  Request a page of the file list from the server as JSON,
+  creates a table of files to display on the webpage. With more, the next page is added to the table
   */
+  let url = "/api/list?format=json&limit=" + LIST_PAGE_SIZE;
+  if (more && listCursor) {
+    url += "&cursor=" + listCursor;
+  }
   const xhr = new XMLHttpRequest();
-  xhr.open("GET", "/api/list", true);
+  xhr.open("GET", url, true);
 
   xhr.onreadystatechange = function () {
     if (xhr.readyState === XMLHttpRequest.DONE && xhr.status === 200) {
-      const response = xhr.responseText.trim();
+      const page = JSON.parse(xhr.responseText);
       const tableWrapper = document.getElementById("fileTableWrapper");
       const tableBody = document.querySelector("#fileTable tbody");
       const emptyMessage = document.getElementById("emptyMessage");
 
-      tableBody.innerHTML = ""; // clear previous rows
+      if (!more) {
+        tableBody.innerHTML = ""; // clear previous rows
+      }
+      listCursor = page.cursor;
+      document.getElementById("moreFiles").style.display = listCursor ? "block" : "none";
 
-      if (response === "There are no files on the server.") {
+      if (page.files.length === 0 && !more) {
         tableWrapper.style.display = "none";
         emptyMessage.style.display = "block";
         return;
@@ -86,12 +97,8 @@ function list() {
         emptyMessage.style.display = "none";
       }
 
-      const lines = response.split("\n");
-      lines.forEach(line => {
-        const row = createFileTableRow(line);
-        if (row) {
-          tableBody.appendChild(row);
-        }
+      page.files.forEach(file => {
+        tableBody.appendChild(createFileTableRow(file));
       });
     }
   };
@@ -99,28 +106,20 @@ function list() {
   xhr.send();
 }
 
-function createFileTableRow(line) {
+function createFileTableRow(file) {
   /*
-  Creates a formatted row for the file-table on the webpage. Takes in a line and formats it to the expected format
+  Creates a formatted row for the file-table on the webpage from a file of the JSON list
   */
-  const parts = line.split(" - ");
-  if (parts.length < 3) return null;
-
-  const filename = decodeURIComponent(parts[0].trim());
-  const sizeBytesMatch = parts[1].match(/(\d+)\s+bytes/);
-  const sizeBytes = sizeBytesMatch ? parseInt(sizeBytesMatch[1]) : 0;
-  const sizeMB = (sizeBytes / (1024 * 1024)).toFixed(2);
-
-  const uploadMatch = parts[2].match(/Uploaded by (.+) on (.+)/);
-  const owner = uploadMatch ? uploadMatch[1].trim() : "Unknown";
-  const timestamp = uploadMatch ? uploadMatch[2].trim() : "Unknown";
+  const filename = decodeURIComponent(file.name);
+  const sizeMB = (file.size / (1024 * 1024)).toFixed(2);
 
   const tr = document.createElement("tr");
+  tr.dataset.name = file.name;
 
   tr.appendChild(createCell(filename));
-  tr.appendChild(createCell(owner));
+  tr.appendChild(createCell(file.owner));
   tr.appendChild(createCell(sizeMB));
-  tr.appendChild(createCell(timestamp));
+  tr.appendChild(createCell(file.timestamp));
 
   const tdActions = document.createElement("td");
   tdActions.appendChild(createDownloadButton(filename));
@@ -130,6 +129,65 @@ function createFileTableRow(line) {
   return tr;
 }
 
+let events = null;
+
+function start_events() {
+  /*
+  Listens for changes to the files (upload, overwrite, delete) and applies them to the table as they happen.
+  The browser reconnects by itself if the stream breaks, the list is fetched again then since changes may have been missed
+  */
+  if (events) return;
+  let opened = false;
+  events = new EventSource("/api/events");
+  events.onopen = function () {
+    if (opened) list();
+    opened = true;
+  };
+  events.onmessage = function (message) {
+    apply_change(JSON.parse(message.data));
+  };
+  events.addEventListener("reset", function () {
+    list();
+  });
+}
+
+function stop_events() {
+  /*
+  Stops listening for changes to the files
+  */
+  if (events) {
+    events.close();
+    events = null;
+  }
+}
+
+function apply_change(change) {
+  /*
+  Applies a change event to the file-table: adds, replaces or removes the row of the file
+  */
+  const tableBody = document.querySelector("#fileTable tbody");
+  const rows = Array.from(tableBody.rows);
+  const row = rows.find(r => r.dataset.name === change.name);
+
+  if (change.event === "delete") {
+    if (row) row.remove();
+  } else if (row) {
+    row.replaceWith(createFileTableRow(change));
+  } else {
+    // Keep the table in name order. A file past the end of the loaded pages shows up with "Show More Files"
+    const next = rows.find(r => r.dataset.name > change.name);
+    if (next) {
+      tableBody.insertBefore(createFileTableRow(change), next);
+    } else if (!listCursor) {
+      tableBody.appendChild(createFileTableRow(change));
+    }
+  }
+
+  const empty = tableBody.rows.length === 0;
+  document.getElementById("fileTableWrapper").style.display = empty ? "none" : "block";
+  document.getElementById("emptyMessage").style.display = empty ? "block" : "none";
+}
+
 function createCell(text) {
   /*
   Helper function to create a single cell in the file-table
@@ -172,6 +230,9 @@ function set_logged_in(logged_in, username="") {
 
     if (logged_in) {
         document.getElementById("welcome_message").textContent = `Welcome ${username}, to TreeDrive File Sharing`;
+        start_events();
+    } else {
+        stop_events();
     }
 }
 
@@ -206,7 +267,7 @@ function uploadFile() {
   xhr.onload = function () {
     if (xhr.status === 200) {
       alert("File uploaded successfully.");
-      list(); // Optionally refresh file list
+      list(); // change events update the list too, but the uploader should not have to wait on them
     } else if (xhr.status === 401) {
         alert("Permission denied. You can not overwrite a file you do not own.")
     } else {
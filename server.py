@@ -14,8 +14,13 @@ server.py
 
     server.py maintains file and user metadata to ensure proper ownership and access.
 
+    Speaks two protocols: the original line based one, and a binary one (v2) a client can switch
+    to with "PROTO 2" before logging in, where every message is a length-prefixed frame.
+
     Requires a file_metadata.json with metadata for files on the server.
-    Requires a directory ./ServerFiles/ to store server files. 
+    Changes to the metadata are appended to file_metadata.journal and folded into file_metadata.json periodically.
+    Requires a directory ./ServerFiles/ to store server files. Uploads are written to ./StagingFiles/
+    and only moved into ./ServerFiles/ once complete, so an interrupted upload can be resumed.
 
     If neither of these exists, the server will attempt to create them automatically.
 
@@ -29,18 +34,76 @@ server.py
 
 import socket as sock
 import sys
-import select
+import selectors
 import json
+import zlib
+import lzma
+import mimetypes
 import os
+import argparse
+import hashlib
+import signal
+import asyncio
+import sqlite3
+import struct
+import threading
+import time
+import bisect
+import base64
+from functools import lru_cache
+from contextlib import nullcontext
+from collections import Counter, deque
+try:
+    import resource     # Unix only, used to raise the open file limit
+except ImportError:
+    resource = None
+try:
+    import fcntl        # Unix only, used to lock staged uploads
+except ImportError:
+    fcntl = None
 from datetime import datetime     #Used for timestamps
 
 CHUNK_SIZE = 65536
+SEND_BURST = 1048576    # Most bytes of a download sent in one go before other clients get a turn
 
 """Constants"""
 SERVER_SELECT_TIMEOUT = 5
+SERVER_BACKLOG = 1024           # Pending connections the OS queues for us between accepts
+MAX_OPEN_FILES = 65536          # Soft open-file limit the server asks for, each client costs one
 SERVER_FILE_PATH = "ServerFiles"
+STAGING_PATH = "StagingFiles"   # Uploads in progress, moved into SERVER_FILE_PATH once complete
+STAGING_MAX_AGE = 86400         # Seconds an interrupted upload is kept around to be resumed
+STORAGE_BACKEND = "files"       # "files" (whole files in SERVER_FILE_PATH) or "blocks" (deduplicated in BLOCK_PATH)
+BLOCK_PATH = "BlockStore"
+BLOCK_SIZE = 262144             # Bytes per block of the block store
 METADATA_FILE = "file_metadata.json"
+METADATA_JOURNAL_FILE = "file_metadata.journal"
+METADATA_FLUSH_INTERVAL = 2     # Seconds between fsyncs of the metadata journal
+METADATA_COMPACT_SIZE = 1048576 # Journal size (bytes) at which it is folded into METADATA_FILE
+METADATA_BACKEND = "json"       # "json" (METADATA_FILE + journal) or "sqlite" (METADATA_DB)
+METADATA_DB = "file_metadata.db"
+SQLITE_BUSY_TIMEOUT = 5000      # Milliseconds to wait on a locked database
+CHANGE_POLL_INTERVAL = 0.2      # Seconds between a worker's looks at the change log the workers share (--workers)
+CHANGE_LOG_SIZE = 10000         # Most recent file changes kept in the shared change log
 TIMESTAMP_FORMAT = "%a %b %d %H:%M:%S %Y"
+LIST_SORT_KEYS = ("name", "size", "time")   # What a LIST can be sorted by, "-name" etc. sorts in reverse
+LIST_MAX_LIMIT = 1000           # Most files in one page of a LIST
+# Upper bounds (seconds) of the buckets of the latency histograms reported by STATS
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+"""---------"""
+
+"""Binary protocol (v2). Every frame is a header (opcode, request id, payload length) followed by the payload"""
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct("!BII")
+FRAME_DATA_SIZE = 262144        # Largest DATA frame the server sends during a GET
+FRAME_MAX_SIZE = 16777216       # Largest frame the server accepts, anything bigger is a broken client
+MAX_TRANSFERS = 64              # PUSH/GETs one v2 connection can have running at once, each holds an open file
+COMPRESSION_METHODS = ("zlib", "lzma")
+COMPRESSION_LEVEL = 6           # Used when a client asks for compression without a level
+# MIME types whose content is compressed already, another pass would cost CPU and save nothing
+COMPRESSED_TYPES = ("image/", "audio/", "video/", "application/zip", "application/gzip", "application/x-7z",
+                    "application/x-rar", "application/java-archive", "application/pdf", "application/vnd.openxmlformats")
+UNCOMPRESSED_TYPES = ("image/svg+xml", "image/bmp", "image/tiff", "audio/x-wav")
 """---------"""
 
 # Load the configured Host and Port for server socket to bind to
@@ -58,6 +121,29 @@ class ClientState:
     SENDING_FILE = "SENDING_FILE"
 """---------"""
 
+"""Enum of the frame types of the binary protocol (v2)"""
+class Opcode:
+    LOGIN = 1       # payload: username
+    LIST = 2        # payload: empty for the whole list as text, or option lines: "prefix <text>", "owner <name>",
+                    # "sort <name|size|time, - in front for reverse>", "limit <n>", "cursor <from the last page>",
+                    # "format json". A page ends in the cursor of the next one, if there is more
+    PUSH = 3        # payload: "<filesize> <filename>", then option lines: "compress <method> [<level>]", "sha256 <hex>"
+    GET = 4         # payload: filename, then option lines: "range <offset> [<length>]", "compress <method> [<level>]"
+    DELETE = 5      # payload: filename
+    DATA = 6        # payload: file bytes of the PUSH/GET with the same request id (a compressed stream if negotiated)
+    READY = 7       # payload: PUSH: offset to send from. GET: the file size ("<length> <offset> <file size>" if
+                    # ranged), then "sha256 <hex>" of the whole file. Then "compress <method>" if the DATA frames
+                    # are compressed
+    OK = 8          # payload: reply text, a PUSH whose sha256 matches the file on the server is answered OK at once
+    ERROR = 9       # payload: error text
+    END = 10        # payload: "<file bytes> <wire bytes>", the last DATA of a GET has been sent
+    SUBSCRIBE = 11  # payload: empty. Answered OK, then every change to the files comes as an EVENT with its request id
+    EVENT = 12      # payload: JSON {"event": "upload"|"overwrite"|"delete", "name", "owner", "size", "timestamp"}
+    STATS = 13      # payload: empty. Answered OK with the server's metrics in the Prometheus text format
+
+OPCODE_NAMES = {value: name for name, value in vars(Opcode).items() if name.isupper()}
+"""---------"""
+
 # The expected schema of the commands for the server. "
 # Includes the number of arguments (command name included) as well as the command signature."
 COMMANDS = {
@@ -82,7 +168,7 @@ COMMANDS = {
 
         "args": 1,
 
-        "signature": "LIST"
+        "signature": "LIST [prefix=<text>] [owner=<name>] [sort=<name|size|time>] [limit=<n>] [cursor=<c>] [format=json]"
 
     },
 
@@ -90,90 +176,985 @@ COMMANDS = {
 
         "args": 2,
 
-        "signature": "GET <filename>"
+        "signature": "GET <filename> [@<offset> [<length>]]"
 
     },
 
     "DELETE": {
         "args": 2,
         "signature": "DELETE <filename>"
+    },
+
+    "STATS": {
+        "args": 1,
+        "signature": "STATS"
     }
 }
 
+#-----------------------------
+#
+# Metrics (STATS). Counters and latency histograms of what the server spends its time on, reported in the
+# Prometheus text format. With --workers, every worker process keeps its own.
+#
+class Histogram:
+    """Counts of observed values (seconds) by LATENCY_BUCKETS, with their sum"""
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)    # The last one is everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    The server's counters and histograms, by name and labels. Sessions, the metadata flusher and asyncio's worker
+    threads all record into it, so it has a lock. Gauges (connections, transfers) are read when a report is made.
+    """
+    HELP = {
+        "commands_total": ("counter", "Commands handled, by command"),
+        "command_errors_total": ("counter", "Commands that were answered with an error, by command"),
+        "command_seconds": ("histogram", "Time to handle a command, PUSH/GET up to their READY"),
+        "transfers_total": ("counter", "Finished uploads and downloads"),
+        "transfer_seconds": ("histogram", "Time an upload or download took, from PUSH/GET to its last byte"),
+        "transfer_bytes_total": ("counter", "File bytes of finished uploads and downloads"),
+        "transfer_wire_bytes_total": ("counter", "Bytes finished uploads and downloads took on the wire (compressed)"),
+        "connections_total": ("counter", "Client connections accepted"),
+        "loop_seconds": ("histogram", "Time the selector loop spent on one batch of ready sockets"),
+        "metadata_seconds": ("histogram", "Time of metadata store operations (load, put, delete, flush, compact)"),
+        "connections": ("gauge", "Clients connected now"),
+        "active_transfers": ("gauge", "Uploads and downloads running now"),
+        "subscribers": ("gauge", "Clients subscribed to file changes"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()   # (name, labels) -> value, labels are a tuple of (label, value) pairs
+        self.histograms = {}        # (name, labels) -> Histogram
+
+    def count(self, name, value=1, **labels):
+        """Adds value to a counter"""
+        with self.lock:
+            self.counters[name, tuple(labels.items())] += value
+
+    def observe(self, name, seconds, **labels):
+        """Records a time in a histogram"""
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def report(self, gauges):
+        """Returns the metrics, plus gauges ({(name, labels): value}), in the Prometheus text format"""
+        with self.lock:
+            series = {**self.counters, **gauges}
+            histograms = {key: (list(h.buckets), h.sum, h.count) for key, h in self.histograms.items()}
+        lines = []
+        for name, (kind, description) in self.HELP.items():
+            lines.append(f"# HELP treedrive_fileserver_{name} {description}")
+            lines.append(f"# TYPE treedrive_fileserver_{name} {kind}")
+            for (seriesName, labels), value in sorted(series.items()):
+                if seriesName == name:
+                    lines.append(f"treedrive_fileserver_{name}{formatLabels(labels)} {value}")
+            for (seriesName, labels), (buckets, total, count) in sorted(histograms.items()):
+                if seriesName != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip((*LATENCY_BUCKETS, "+Inf"), buckets):
+                    cumulative += bucket
+                    lines.append(f"treedrive_fileserver_{name}_bucket{formatLabels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"treedrive_fileserver_{name}_sum{formatLabels(labels)} {total:.6f}")
+                lines.append(f"treedrive_fileserver_{name}_count{formatLabels(labels)} {count}")
+        return "\n".join(lines)
+
+def formatLabels(labels):
+    """Formats (label, value) pairs as a Prometheus label set, {a="1",b="2"}"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+metrics = Metrics()
+liveConnections = set()     # Every connected client's Connection, for the gauges of STATS
+
+def recordCommand(command, started, failed=False):
+    """Records a command that was handled, started being its time.perf_counter() when it arrived"""
+    metrics.count("commands_total", command=command)
+    metrics.observe("command_seconds", time.perf_counter() - started, command=command)
+    if failed:
+        metrics.count("command_errors_total", command=command)
+
+def recordTransfer(direction, began, filebytes, wirebytes):
+    """Records a finished upload or download"""
+    metrics.count("transfers_total", direction=direction)
+    metrics.observe("transfer_seconds", time.perf_counter() - began, direction=direction)
+    metrics.count("transfer_bytes_total", filebytes, direction=direction)
+    metrics.count("transfer_wire_bytes_total", wirebytes, direction=direction)
+
+def com_STATS():
+    """Returns the server's metrics in the Prometheus text format"""
+    uploads = downloads = 0
+    for conn in list(liveConnections):
+        uploads += len(conn.uploads) + (conn.state == ClientState.RECEIVING_FILE)
+        downloads += len(conn.downloads) + (conn.state == ClientState.SENDING_FILE)
+    return metrics.report({
+        ("connections", ()): len(liveConnections),
+        ("active_transfers", (("direction", "upload"),)): uploads,
+        ("active_transfers", (("direction", "download"),)): downloads,
+        ("subscribers", ()): len(subscribers),
+    })
+# end of Metrics
+#-----------------------------
+
 #-----------------------------
 #
 # Functions for Managing the file Metadata
 #
-def loadMetadata():
+def loadMetadata(path=METADATA_FILE):
     """
-    Attemps to load metadata from METADATA_FILE into a dictionary and return the metadata as a dictionary
+    Attemps to load metadata from path into a dictionary and return the metadata as a dictionary
     """
     metadata = {}
     try:
-        with open(METADATA_FILE, "r") as f:
+        with open(path, "r") as f:
             content = f.read().strip()
             if content:  # Not empty
                 metadata = json.loads(content)
     except FileNotFoundError:
-        print(f"Metadata file does not exist. Creating file '{METADATA_FILE}'")
-        f = open(METADATA_FILE, "x")
+        print(f"Metadata file does not exist. Creating file '{path}'")
+        open(path, "x").close()
     return metadata
 
-def saveMetadata(metadata):
+def saveMetadata(metadata, path=METADATA_FILE):
     """
-    Saves metadata to METADATA_FILE
+    Saves metadata to path. Writes to a temporary file first and swaps it in, so a crash mid-write
+    never leaves a half-written metadata file behind.
     """
-    with open(METADATA_FILE, "w") as f:
-        json.dump(metadata, f, indent=6)
-
-def addMetadata(filename, owner):
+    tmpPath = f"{path}.tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(metadata, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
+
+def replayJournal(metadata, path):
     """
-    Adds relevant metadata (owner, timestamp, filesize) to filename and then saves the metadata 
+    Applies every record of the journal at path to the metadata dictionary, in order.
+
+    A crash can leave the last record half-written, so replay stops at the first record that does not
+    parse and the journal is cut back to the end of the last good record. Returns the number of records applied.
     """
+    applied = 0
+    goodBytes = 0
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("torn record")
+                    record = json.loads(line)
+                    if record["op"] == "delete":
+                        metadata.pop(record["file"], None)
+                    else:   # "add" and "overwrite" both carry the full metadata
+                        metadata[record["file"]] = record["meta"]
+                except (ValueError, KeyError):
+                    print(f"Error: Dropping damaged tail of metadata journal '{path}'")
+                    break
+                goodBytes += len(line)
+                applied += 1
+    except FileNotFoundError:
+        return 0
+    if goodBytes != os.path.getsize(path):
+        os.truncate(path, goodBytes)
+    return applied
+
+@lru_cache(maxsize=65536)
+def uploadedTime(timestamp):
+    """The time a metadata timestamp stands for, in seconds since the epoch. Cached, many uploads share a second"""
     try:
-        metadata = loadMetadata()
-        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
-        metadata[filename] = {
-            "owner": owner,
-            "filesize": os.path.getsize(f"{SERVER_FILE_PATH}/{filename}"),
-            "timestamp": timestamp
-        }
-        saveMetadata(metadata)
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+    except ValueError:
+        return 0.0
+
+def sortValue(sort, filename, entry):
+    """The value of a file that a LIST sorts by"""
+    if sort == "size":
+        return entry["filesize"]
+    if sort == "time":
+        return uploadedTime(entry["timestamp"])
+    return filename
+
+class MetadataStore:
+    """
+    Holds the file metadata in memory so commands are answered with dictionary lookups.
+
+    On disk the metadata is a snapshot (METADATA_FILE) plus an append-only journal (METADATA_JOURNAL_FILE)
+    holding one record per add, overwrite or delete since the snapshot was taken. Startup loads the snapshot
+    and replays the journal on top of it, so each change only costs a small append instead of a full rewrite.
+    Whatever startup replayed is written into a new snapshot straight away, before the journal takes new records.
+
+    A background thread fsyncs the journal every flushInterval seconds, and compacts it into a new snapshot
+    once it grows past compactSize bytes. close() compacts whatever is left on shutdown.
+    """
+    def __init__(self, path=METADATA_FILE, journalPath=METADATA_JOURNAL_FILE,
+                 flushInterval=METADATA_FLUSH_INTERVAL, compactSize=METADATA_COMPACT_SIZE):
+        self.path = path
+        self.journalPath = journalPath
+        self.compactingPath = f"{journalPath}.compacting"
+        self.flushInterval = flushInterval
+        self.compactSize = compactSize
+
+        self.files = loadMetadata(path)
+        # A journal left over from a compaction that never finished comes before the live journal
+        replayed = replayJournal(self.files, self.compactingPath)
+        replayed += replayJournal(self.files, journalPath)
+        if replayed:
+            print(f"Replayed {replayed} metadata journal record(s)")
+        if replayed or os.path.exists(self.compactingPath):
+            # Fold what was replayed into the snapshot now. A compaction that never finished would otherwise
+            # leave its journal around for the next compact() to overwrite, losing its records if that one fails too
+            saveMetadata(self.files, path)
+            if os.path.exists(self.compactingPath):
+                os.remove(self.compactingPath)
+            open(journalPath, "wb").close()
+        self.blockRefs = Counter()      # Block -> references from file block lists, rebuilt from the files at startup
+        for entry in self.files.values():
+            self.blockRefs.update(entry.get("blocks", ()))
+        self.names = sorted(self.files) # Filenames in order, for paging through LIST
+        self.sortIndexes = {}           # "size"/"time" -> sorted [(value, filename)], built by the first LIST that needs one
+
+        self.journal = open(journalPath, "ab")
+        self.dirty = False              # Journal has appends that are not fsynced yet
+        self.lock = threading.Lock()    # Guards files/journal against the flusher thread
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flushLoop, daemon=True)
+
+    def start(self):
+        """Start the background flusher thread"""
+        self.flusher.start()
+
+    def get(self, filename):
+        """Returns the metadata of filename, or None if the server has no such file"""
+        return self.files.get(filename)
+
+    def items(self):
+        """Returns a list of (filename, metadata) pairs for every file on the server"""
+        return list(self.files.items())
+
+    def page(self, prefix="", owner=None, sort="name", descending=False, after=None, limit=LIST_MAX_LIMIT):
+        """
+        Returns up to limit (filename, metadata) pairs of the files starting with prefix (and owned by owner),
+        in sort order. after is the (sort value, filename) of the last file of the page before.
+        Every order is a sorted list (the filenames, or a sort index), so a page is a binary search for where it
+        starts and a walk from there.
+        """
+        with self.lock:
+            if sort == "name":
+                start = bisect.bisect_left(self.names, prefix)
+                end = bisect.bisect_left(self.names, prefix + chr(0x10FFFF), start)
+                if after is not None:
+                    if descending:
+                        end = min(end, bisect.bisect_left(self.names, after[1], start, end))
+                    else:
+                        start = max(start, bisect.bisect_right(self.names, after[1], start, end))
+                names = (self.names[i] for i in (reversed(range(start, end)) if descending else range(start, end)))
+            else:
+                keys = self.sortIndex(sort)
+                if descending:
+                    end = bisect.bisect_left(keys, tuple(after)) if after is not None else len(keys)
+                    names = (keys[i][1] for i in reversed(range(end)))
+                else:
+                    start = bisect.bisect_right(keys, tuple(after)) if after is not None else 0
+                    names = (keys[i][1] for i in range(start, len(keys)))
+                names = (name for name in names if name.startswith(prefix))
+            page = []
+            for name in names:
+                entry = self.files[name]
+                if owner is None or entry["owner"] == owner:
+                    page.append((name, entry))
+                    if len(page) == limit:
+                        break
+            return page
+
+    def sortIndex(self, sort):
+        """Returns the sorted [(value, filename)] index of an order other than name, building it if need be"""
+        if sort not in self.sortIndexes:
+            self.sortIndexes[sort] = sorted((sortValue(sort, name, entry), name) for name, entry in self.files.items())
+        return self.sortIndexes[sort]
+
+    def updateSortIndexes(self, filename, old, new):
+        """Moves filename within the sort indexes from its old metadata entry to the new one (either may be None)"""
+        for sort, keys in self.sortIndexes.items():
+            if old is not None:
+                del keys[bisect.bisect_left(keys, (sortValue(sort, filename, old), filename))]
+            if new is not None:
+                bisect.insort(keys, (sortValue(sort, filename, new), filename))
+
+    def append(self, record):
+        """Appends a single record to the journal. Caller must hold the lock"""
+        self.journal.write(json.dumps(record).encode("utf-8") + b"\n")
+        self.journal.flush()    # Hand it to the OS now, so a crash of the server itself loses nothing
+        self.dirty = True
+
+    def releaseBlocks(self, entry):
+        """Drops the block references of a replaced or deleted entry. Returns the blocks nothing refers to any more"""
+        freed = []
+        for block in entry.get("blocks", ()) if entry else ():
+            self.blockRefs[block] -= 1
+            if self.blockRefs[block] == 0:
+                del self.blockRefs[block]
+                freed.append(block)
+        return freed
+
+    def put(self, filename, entry):
+        """Adds or replaces the metadata of filename. Returns the blocks of a replaced version nothing refers to any more"""
+        with self.lock:
+            old = self.files.get(filename)
+            op = "overwrite" if old is not None else "add"
+            self.files[filename] = entry
+            if old is None:
+                bisect.insort(self.names, filename)
+            self.updateSortIndexes(filename, old, entry)
+            self.append({"op": op, "file": filename, "meta": entry})
+            self.blockRefs.update(entry.get("blocks", ()))
+            return self.releaseBlocks(old)
+
+    def delete(self, filename):
+        """Removes the metadata of filename. Returns the blocks of the file nothing refers to any more"""
+        with self.lock:
+            old = self.files.pop(filename, None)
+            if old is None:
+                return []
+            del self.names[bisect.bisect_left(self.names, filename)]
+            self.updateSortIndexes(filename, old, None)
+            self.append({"op": "delete", "file": filename})
+            return self.releaseBlocks(old)
+
+    def flush(self):
+        """fsyncs any journal appends made since the last flush"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            fd = self.journal.fileno()
+        started = time.perf_counter()
+        os.fsync(fd)
+        metrics.observe("metadata_seconds", time.perf_counter() - started, operation="flush")
+
+    def compact(self):
+        """
+        Folds the journal into a new snapshot.
+
+        The live journal is set aside and a fresh one started while holding the lock, so new records keep
+        going somewhere safe. The snapshot is written outside the lock, and the set-aside journal is only
+        removed once the snapshot is in place. If the server dies part way, startup replays the set-aside journal.
+        """
+        with self.lock:
+            if self.journal.tell() == 0:
+                return
+            snapshot = dict(self.files)  # Entries are replaced, never mutated, so a shallow copy is enough
+            self.journal.close()
+            os.replace(self.journalPath, self.compactingPath)
+            self.journal = open(self.journalPath, "ab")
+            self.dirty = False
+        started = time.perf_counter()
+        saveMetadata(snapshot, self.path)
+        os.remove(self.compactingPath)
+        metrics.observe("metadata_seconds", time.perf_counter() - started, operation="compact")
+
+    def flushLoop(self):
+        """Flusher thread: flush every flushInterval seconds and compact when the journal gets large"""
+        while not self.stopped.wait(self.flushInterval):
+            try:
+                self.flush()
+                if self.journal.tell() >= self.compactSize:
+                    self.compact()
+            except OSError as e:
+                print(f"Error: Failed to save metadata: {e}")
+
+    def close(self):
+        """Stop the flusher thread and fold the journal into the snapshot"""
+        self.stopped.set()
+        if self.flusher.is_alive():
+            self.flusher.join()
+        self.flush()
+        self.compact()
+        self.journal.close()
+
+class SQLiteMetadataStore:
+    """
+    Metadata store backed by the stdlib sqlite3 module, selected with METADATA_BACKEND = "sqlite".
+
+    Same interface as MetadataStore, but nothing has to be held in memory or replayed at startup:
+    lookups by filename go through the primary key, and owner, size and upload time have their own indexes.
+    The database runs in WAL mode, so each change is a small append to the write-ahead log.
+    Fields other than owner/filesize/timestamp are kept as JSON in the extra column.
+    The blocks table counts the references to every block of the block store, updated in the same transaction.
+    The changes table is the log of file changes the worker processes share (--workers), see pollChanges.
+    """
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS files (
+            filename  TEXT PRIMARY KEY,
+            owner     TEXT NOT NULL,
+            filesize  INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            uploaded  REAL NOT NULL,
+            extra     TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS files_owner ON files (owner, filename)",
+        "CREATE INDEX IF NOT EXISTS files_uploaded ON files (uploaded, filename)",
+        "CREATE INDEX IF NOT EXISTS files_size ON files (filesize, filename)",
+        """CREATE TABLE IF NOT EXISTS blocks (
+            hash      TEXT PRIMARY KEY,
+            refs      INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS changes (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload   BLOB NOT NULL
+        )""",
+    )
+
+    def __init__(self, path=METADATA_DB):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)  # Autocommit, each change is its own transaction
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+    def start(self):
+        """Nothing runs in the background, sqlite writes changes as they happen"""
+
+    @staticmethod
+    def toRow(filename, entry):
+        """Turns a metadata entry into a row for the files table"""
+        uploaded = uploadedTime(entry["timestamp"])
+        extra = {key: val for key, val in entry.items() if key not in ("owner", "filesize", "timestamp")}
+        return (filename, entry["owner"], entry["filesize"], entry["timestamp"], uploaded,
+                json.dumps(extra) if extra else None)
+
+    @staticmethod
+    def toEntry(row):
+        """Turns a (owner, filesize, timestamp, extra) row back into a metadata entry"""
+        owner, filesize, timestamp, extra = row
+        entry = {"owner": owner, "filesize": filesize, "timestamp": timestamp}
+        if extra:
+            entry.update(json.loads(extra))
+        return entry
+
+    def get(self, filename):
+        """Returns the metadata of filename, or None if the server has no such file"""
+        row = self.db.execute(
+            "SELECT owner, filesize, timestamp, extra FROM files WHERE filename = ?", (filename,)
+        ).fetchone()
+        return self.toEntry(row) if row else None
+
+    def items(self):
+        """Returns a list of (filename, metadata) pairs for every file on the server, ordered by filename"""
+        rows = self.db.execute("SELECT filename, owner, filesize, timestamp, extra FROM files ORDER BY filename")
+        return [(row[0], self.toEntry(row[1:])) for row in rows]
+
+    SORT_COLUMNS = {"name": "filename", "size": "filesize", "time": "uploaded"}
+
+    def page(self, prefix="", owner=None, sort="name", descending=False, after=None, limit=LIST_MAX_LIMIT):
+        """
+        Returns up to limit (filename, metadata) pairs of the files starting with prefix (and owned by owner),
+        in sort order. after is the (sort value, filename) of the last file of the page before.
+        Pages are found through the indexes, so a page costs the same however far into the list it is.
+        """
+        column = self.SORT_COLUMNS[sort]
+        compare, order = ("<", "DESC") if descending else (">", "ASC")
+        where, params = [], []
+        if prefix:
+            where.append("filename >= ? AND filename < ?")
+            params += [prefix, prefix + chr(0x10FFFF)]
+        if owner is not None:
+            where.append("owner = ?")
+            params.append(owner)
+        if after is not None:
+            if sort == "name":
+                where.append(f"filename {compare} ?")
+                params.append(after[1])
+            else:
+                where.append(f"({column}, filename) {compare} (?, ?)")
+                params += list(after)
+        query = "SELECT filename, owner, filesize, timestamp, extra FROM files"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {column} {order}, filename {order} LIMIT ?"
+        rows = self.db.execute(query, params + [limit])
+        return [(row[0], self.toEntry(row[1:])) for row in rows]
+
+    def releaseBlocks(self, filename):
+        """
+        Drops the block references of the current entry of filename. Returns the blocks nothing refers to any more.
+        Caller must be in a transaction
+        """
+        old = self.get(filename)
+        freed = []
+        for block in old.get("blocks", ()) if old else ():
+            self.db.execute("UPDATE blocks SET refs = refs - 1 WHERE hash = ?", (block,))
+            if self.db.execute("DELETE FROM blocks WHERE hash = ? AND refs <= 0", (block,)).rowcount:
+                freed.append(block)
+        return freed
+
+    def writeEntry(self, filename, entry):
+        """Adds or replaces the metadata of filename and its block references. Caller must be in a transaction"""
+        self.db.executemany("INSERT INTO blocks VALUES (?, 1) ON CONFLICT (hash) DO UPDATE SET refs = refs + 1",
+                            ((block,) for block in entry.get("blocks", ())))
+        freed = self.releaseBlocks(filename)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", self.toRow(filename, entry))
+        return freed
+
+    def put(self, filename, entry):
+        """Adds or replaces the metadata of filename. Returns the blocks of a replaced version nothing refers to any more"""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.writeEntry(filename, entry)
+
+    def putMany(self, entries):
+        """Adds or replaces many (filename, metadata) pairs in a single transaction"""
+        with self.db:
+            self.db.execute("BEGIN")
+            for filename, entry in entries:
+                self.writeEntry(filename, entry)
+
+    def delete(self, filename):
+        """Removes the metadata of filename. Returns the blocks of the file nothing refers to any more"""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            freed = self.releaseBlocks(filename)
+            self.db.execute("DELETE FROM files WHERE filename = ?", (filename,))
+            return freed
+
+    def logChange(self, payload):
+        """Appends the EVENT payload of a file change to the change log, dropping the oldest past CHANGE_LOG_SIZE"""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            changeId = self.db.execute("INSERT INTO changes (payload) VALUES (?)", (payload,)).lastrowid
+            self.db.execute("DELETE FROM changes WHERE id <= ?", (changeId - CHANGE_LOG_SIZE,))
+
+    def lastChange(self):
+        """The id of the newest entry in the change log, 0 if it is empty"""
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+
+    def changesSince(self, changeId):
+        """The (id, payload) entries of the change log after changeId, oldest first"""
+        return self.db.execute("SELECT id, payload FROM changes WHERE id > ? ORDER BY id", (changeId,)).fetchall()
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+def openMetadataStore(backend=METADATA_BACKEND):
+    """Creates the metadata store for the configured backend ("json" or "sqlite")"""
+    started = time.perf_counter()
+    store = SQLiteMetadataStore() if backend == "sqlite" else MetadataStore()
+    metrics.observe("metadata_seconds", time.perf_counter() - started, operation="load")
+    return store
+
+def migrateMetadata():
+    """
+    Imports file_metadata.json (plus anything still in its journal) into the sqlite database at METADATA_DB.
+    Existing rows for the same filenames are replaced, so it is safe to run more than once.
+    """
+    metadata = loadMetadata(METADATA_FILE)
+    replayJournal(metadata, f"{METADATA_JOURNAL_FILE}.compacting")
+    replayJournal(metadata, METADATA_JOURNAL_FILE)
+    store = SQLiteMetadataStore()
+    store.putMany(metadata.items())
+    store.close()
+    print(f"Migrated metadata for {len(metadata)} file(s) from '{METADATA_FILE}' into '{METADATA_DB}'")
+
+metadataStore = None    # The server's metadata store, created in main()
+
+def addMetadata(filename, owner, filesize, blocks=None, checksum=None):
+    """
+    Adds relevant metadata (owner, timestamp, filesize, SHA-256, and the block list of a file in the block store) to
+    filename in the metadata store. Returns the blocks of a replaced version nothing refers to any more
+    """
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    entry = {
+        "owner": owner,
+        "filesize": filesize,
+        "timestamp": timestamp
+    }
+    if checksum is not None:
+        entry["sha256"] = checksum
+    if blocks is not None:
+        entry["blocks"] = blocks
+        entry["blocksize"] = BLOCK_SIZE
+    existed = (bool(subscribers) or lastChange is not None) and metadataStore.get(filename) is not None
+    started = time.perf_counter()
+    freed = metadataStore.put(filename, entry)
+    metrics.observe("metadata_seconds", time.perf_counter() - started, operation="put")
+    publishChange("overwrite" if existed else "upload", filename, entry)
+    return freed
 
 def deleteMetadata(filename):
     """
-    Removes metadata for filename from METADATA_FILE
+    Removes metadata for filename from the metadata store. Returns the blocks of the file nothing refers to any more
     """
-    try:
-        metadata = loadMetadata()
-        if filename in metadata:
-            metadata.pop(filename)
-            saveMetadata(metadata)
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
+    entry = metadataStore.get(filename) if subscribers or lastChange is not None else None
+    started = time.perf_counter()
+    freed = metadataStore.delete(filename)
+    metrics.observe("metadata_seconds", time.perf_counter() - started, operation="delete")
+    if entry is not None:
+        publishChange("delete", filename, entry)
+    return freed
 # end of Functions for Managing the file Metadata
 #-----------------------------
 
 #-----------------------------
 #
-# Functions for each valid server command
+# File change events (v2 SUBSCRIBE). Every upload, overwrite and delete is sent to the subscribed clients as an EVENT.
+# With --workers, changes go through a change log in the shared SQLite database instead, which every worker polls
+# (pollChanges), so a client hears about the changes made through the other workers too.
 #
-def com_LIST():
-    """Returns the files in the SERVER_FILE_PATH that have existing metadata as a formatted string"""
-    files = os.listdir(SERVER_FILE_PATH)
-    message = ""
-    meta = loadMetadata()
-    if not files:
-        message = "There are no files on the server.\n"
+subscribers = set()     # Connections that sent SUBSCRIBE
+lastChange = None       # With --workers, the id of the last change log entry sent to subscribers. None otherwise
+
+def subscribe(conn, requestId):
+    """Subscribes a client to file changes, which come as EVENT frames with requestId. Returns the reply for the client"""
+    if conn.notify is None:
+        raise CommandError("Error: This server cannot send file change events.")
+    conn.subscription = requestId
+    subscribers.add(conn)
+    print(f"{conn.username} on {conn.addr} subscribed to file changes\n")
+    return "Subscribed to file changes."
+
+def unsubscribe(conn):
+    """Stops sending file changes to a client, when it disconnects"""
+    subscribers.discard(conn)
+    conn.subscription = None
+
+def publishChange(event, filename, entry):
+    """
+    Sends a change to filename, with its (new or deleted) metadata entry, to every subscribed client. With
+    --workers it goes into the change log, for every worker to send to its own subscribers.
+    """
+    if not subscribers and lastChange is None:
+        return
+    payload = json.dumps({"event": event, "name": filename, "owner": entry["owner"], "size": entry["filesize"],
+                          "timestamp": entry["timestamp"]}).encode("utf-8")
+    if lastChange is not None:
+        metadataStore.logChange(payload)
     else:
-        for file in files:
-            if file in meta:
-                message += f"{file} - {meta[file]['filesize']} bytes - Uploaded by {meta[file]['owner']} on {meta[file]['timestamp']}\n"
+        sendChange(payload)
+
+def pollChanges():
+    """With --workers, sends the changes any worker logged since the last poll to this worker's subscribers"""
+    global lastChange
+    for changeId, payload in metadataStore.changesSince(lastChange):
+        lastChange = changeId
+        sendChange(payload)
+
+def sendChange(payload):
+    """Sends the EVENT payload of a file change to every subscribed client"""
+    for conn in list(subscribers):
+        try:
+            conn.notify(packFrame(Opcode.EVENT, conn.subscription, payload))
+        except OSError:
+            pass    # Its own socket reports the error, and it is unsubscribed when it is removed
+# end of File change events
+#-----------------------------
+
+#-----------------------------
+#
+# Block storage (--storage blocks). Files are kept as lists of content-addressed blocks instead of whole files.
+#
+class BlockStore:
+    """
+    Content-addressed block storage. A file is split into BLOCK_SIZE blocks and every distinct block is stored
+    once, at BLOCK_PATH/<first two hex digits>/<sha256>, so files that share content share its blocks.
+    The metadata store keeps each file's block list and counts the references to every block, blocks nothing
+    refers to any more are removed.
+
+    Used as a context manager around freeing blocks together with the metadata change, which holds a lock shared
+    with the other worker processes. Writing blocks does not need it, a block is only ever replaced by the same
+    content. A block one worker has just written can still be freed by another before the new file refers to it,
+    so keepBlocks puts any such block back under the lock, before the metadata change.
+    """
+    def __init__(self, path=BLOCK_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lockfile = open(os.path.join(path, ".lock"), "ab")
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_UN)
+
+    def blockPath(self, digest):
+        """Where the block with the given sha256 hex digest is kept"""
+        return os.path.join(self.path, digest[:2], digest)
+
+    def writeBlock(self, digest, block):
+        """
+        Stores a block under its sha256 hex digest. It is written to a temporary file of this process and thread
+        first, so a block only ever appears whole, even with several writers of the same block at once
+        """
+        blockPath = self.blockPath(digest)
+        os.makedirs(os.path.dirname(blockPath), exist_ok=True)
+        temp = f"{blockPath}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temp, "wb") as out:
+            out.write(block)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temp, blockPath)
+
+    def storeFile(self, path):
+        """
+        Splits the file at path into blocks and stores the ones that are not stored yet. Returns the file's block
+        list. Runs without the lock, call keepBlocks under it before the metadata refers to the blocks
+        """
+        blocks = []
+        written = 0
+        with open(path, "rb") as f:
+            while block := f.read(BLOCK_SIZE):
+                digest = hashlib.sha256(block).hexdigest()
+                blocks.append(digest)
+                if os.path.exists(self.blockPath(digest)):
+                    continue    # Already stored for some other file (or earlier in this one)
+                self.writeBlock(digest, block)
+                written += len(block)
+        print(f"Stored {len(blocks)} block(s), {written} new bytes written\n")
+        return blocks
+
+    def keepBlocks(self, path, blocks):
+        """
+        Writes any of blocks (the block list storeFile returned for the file at path) again that were freed since
+        storeFile stored or found them. Caller must hold the lock, so none can be freed from here until the
+        metadata change that refers to them
+        """
+        missing = [index for index, digest in enumerate(blocks) if not os.path.exists(self.blockPath(digest))]
+        if not missing:
+            return
+        with open(path, "rb") as f:
+            for index in missing:
+                f.seek(index * BLOCK_SIZE)
+                self.writeBlock(blocks[index], f.read(BLOCK_SIZE))
+        print(f"Stored {len(missing)} block(s) again that were freed in the meantime\n")
+
+    def free(self, digests):
+        """Removes blocks that no file refers to any more. Caller must hold the lock"""
+        for digest in digests:
+            try:
+                os.remove(self.blockPath(digest))
+            except FileNotFoundError:
+                pass
+
+def blockLock(entry):
+    """
+    The block store's lock, for a metadata change of a file whose current metadata is entry, or a stand-in that
+    does nothing if the change can neither refer to blocks nor free any. Without the block store only an entry from
+    before a switch away from it has blocks, and a file never goes back to blocks, so there is nothing to lock.
+    """
+    if storageBackend == "blocks" or (entry is not None and "blocks" in entry):
+        return blockStore
+    return nullcontext()
+
+class BlockFile:
+    """
+    Stands in for the open file of a GET when the file is kept in the BlockStore. Blocks are opened one at a time,
+    as the transfer reaches them.
+    """
+    def __init__(self, store, blocks, blocksize):
+        self.store = store
+        self.blocks = blocks
+        self.blocksize = blocksize
+        self.index = None       # Block that is open
+        self.handle = None
+
+    def locate(self, offset):
+        """Returns the file descriptor of the block holding offset, where offset is in it and the bytes left in the block"""
+        index = offset // self.blocksize
+        if index != self.index:
+            self.close()
+            try:
+                self.handle = open(self.store.blockPath(self.blocks[index]), "rb")
+            except FileNotFoundError:
+                # The file was deleted or overwritten part way through the download
+                raise ConnectionAbortedError(f"Block {self.blocks[index]} is gone")
+            self.index = index
+        within = offset - index * self.blocksize
+        return self.handle.fileno(), within, self.blocksize - within
+
+    def read(self, offset, count):
+        """Reads up to count bytes from offset on, never past the end of a block"""
+        _, within, available = self.locate(offset)
+        self.handle.seek(within)
+        return self.handle.read(min(count, available))
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+            self.index = None
+
+blockStore = None       # The server's block store, created in runServer() if there is one to use
+storageBackend = STORAGE_BACKEND    # Where new uploads go, set from --storage
+# end of Block storage
+#-----------------------------
+
+#-----------------------------
+#
+# On-the-wire compression (v2). A PUSH or GET can ask for its DATA frames to be sent as one zlib or lzma stream.
+#
+def isCompressed(filename):
+    """True if filename's type says its content is compressed already (images, video, archives...)"""
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if encoding is not None:    # .gz, .bz2, .xz...
+        return True
+    if mimetype is None:
+        return False
+    return mimetype.startswith(COMPRESSED_TYPES) and not mimetype.startswith(UNCOMPRESSED_TYPES)
+
+def parseCompression(tokens):
+    """Turns the "<method> [<level>]" tokens of a compress option into (method, level)"""
+    if not 1 <= len(tokens) <= 2 or tokens[0] not in COMPRESSION_METHODS:
+        raise CommandError(f"Error: compress expects one of {', '.join(COMPRESSION_METHODS)} and an optional level.")
+    if len(tokens) == 1:
+        return tokens[0], COMPRESSION_LEVEL
+    if not tokens[1].isdigit() or int(tokens[1]) > 9:
+        raise CommandError("Error: Compression level must be 0-9.")
+    return tokens[0], int(tokens[1])
+
+def newCompressor(method, level):
+    """Compressor for the DATA frames of a GET"""
+    if method == "lzma":
+        return lzma.LZMACompressor(preset=level)
+    return zlib.compressobj(level)
+
+def newDecompressor(method):
+    """Decompressor for the DATA frames of a PUSH"""
+    if method == "lzma":
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj()
+
+def decompressPieces(codec, data):
+    """
+    Feeds data to a decompressor and yields what comes out, at most CHUNK_SIZE bytes at a time so a small frame
+    cannot blow up into an unbounded amount of memory. Raises ConnectionAbortedError if the stream is broken.
+    """
+    try:
+        while True:
+            piece = codec.decompress(data, CHUNK_SIZE)
+            if piece:
+                yield piece
+            if codec.eof:
+                if codec.unused_data:
+                    raise ConnectionAbortedError("Data was sent after the end of a compressed stream")
+                return
+            if isinstance(codec, lzma.LZMADecompressor):
+                if codec.needs_input:
+                    return
+                data = b""
             else:
-                print(f"Error: Missing metadata for file '{file}'.\n")
-    return message
+                data = codec.unconsumed_tail
+                if not data and len(piece) < CHUNK_SIZE:
+                    return
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ConnectionAbortedError(f"Broken compressed stream: {e}")
+# end of On-the-wire compression
+#-----------------------------
+
+#-----------------------------
+#
+# Functions for each valid server command
+#
+class CommandError(Exception):
+    """A command could not be carried out. The message is the reply for the client"""
+
+def com_LIST(options=None):
+    """
+    Returns the files on the server as a formatted string. Metadata is the source of truth for what is on the server.
+    With options (see parseListOptions) it returns one page of the files instead, as text or as JSON.
+    """
+    if not options:
+        files = metadataStore.items()
+        if not files:
+            return "There are no files on the server."
+        return "\n".join(
+            f"{file} - {meta['filesize']} bytes - Uploaded by {meta['owner']} on {meta['timestamp']}"
+            for file, meta in files
+        )
+
+    sort, descending, limit = options["sort"], options["descending"], options["limit"]
+    files = metadataStore.page(options["prefix"], options["owner"], sort, descending, options["after"], limit + 1)
+    cursor = None
+    if len(files) > limit: # there is another page, it starts after the last file of this one
+        files = files[:limit]
+        last, meta = files[-1]
+        cursor = encodeCursor(sort, descending, sortValue(sort, last, meta), last)
+
+    if options["json"]:
+        return json.dumps({
+            "files": [{"name": file, "owner": meta["owner"], "size": meta["filesize"], "timestamp": meta["timestamp"]}
+                      for file, meta in files],
+            "cursor": cursor,
+        })
+    if not files:
+        return "There are no files on the server."
+    lines = [f"{file} - {meta['filesize']} bytes - Uploaded by {meta['owner']} on {meta['timestamp']}" for file, meta in files]
+    if cursor:
+        lines.append(f"More files: repeat this LIST with cursor={cursor}")
+    return "\n".join(lines)
+
+def encodeCursor(sort, descending, value, filename):
+    """Packs where the next page of a LIST starts into an opaque token"""
+    return base64.urlsafe_b64encode(json.dumps([sort, descending, value, filename]).encode("utf-8")).decode("ascii")
+
+def decodeCursor(cursor, sort, descending):
+    """Unpacks a token from encodeCursor into (sort value, filename). It must come from a LIST in the same order"""
+    try:
+        cursorSort, cursorDescending, value, filename = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise CommandError("Error: Invalid LIST cursor.")
+    if (cursorSort, cursorDescending) != (sort, descending):
+        raise CommandError("Error: The LIST cursor is from a list in another order.")
+    # The values are compared with the store's keys, a value of another type would fail there instead
+    valueTypes = str if sort == "name" else (int, float)
+    if not isinstance(filename, str) or not isinstance(value, valueTypes) or isinstance(value, bool):
+        raise CommandError("Error: Invalid LIST cursor.")
+    return value, filename
+
+def parseListOptions(options):
+    """
+    Turns the options of a LIST ({name: [values]}, from option lines or name=value arguments) into the arguments of
+    a page: prefix, owner, sort, descending, limit, after and json. Returns None for a plain LIST
+    """
+    if not options:
+        return None
+    sort = " ".join(options.get("sort", ["name"])).lower()
+    descending = sort.startswith("-")
+    sort = sort.lstrip("-")
+    if sort not in LIST_SORT_KEYS:
+        raise CommandError(f"Error: LIST can sort by {', '.join(LIST_SORT_KEYS)}.")
+    limit = " ".join(options.get("limit", [str(LIST_MAX_LIMIT)]))
+    if not limit.isdigit() or int(limit) < 1:
+        raise CommandError("Error: LIST limit must be a positive number.")
+    owner = " ".join(options["owner"]) if options.get("owner") else None
+    cursor = " ".join(options.get("cursor", []))
+    return {
+        "prefix": " ".join(options.get("prefix", [])),
+        "owner": owner,
+        "sort": sort,
+        "descending": descending,
+        "limit": min(int(limit), LIST_MAX_LIMIT),
+        "after": decodeCursor(cursor, sort, descending) if cursor else None,
+        "json": " ".join(options.get("format", [])).lower() == "json",
+    }
 
 
 def com_DELETE(username, args):
@@ -181,27 +1162,589 @@ def com_DELETE(username, args):
     Delete a file from the server if the username owns that file
     """
     filename = args[0]
-    meta = loadMetadata()
-    try:
-        if username == meta[filename]["owner"]:
+    meta = metadataStore.get(filename)
+    if meta is None:
+        raise CommandError(f"Error: File '{filename}' not found.")
+    if username != meta["owner"]:
+        raise CommandError("Permission denied. You are not the owner of this file.")
+    if "blocks" not in meta:
+        try:
             os.remove(f"{SERVER_FILE_PATH}/{filename}")
-            message = f"File '{filename}' deleted."
-            deleteMetadata(filename)
+        except FileNotFoundError:
+            print(f"Error: File '{filename}' was already missing from {SERVER_FILE_PATH}.\n")
+    with blockLock(meta):
+        freed = deleteMetadata(filename)
+        if freed:
+            blockStore.free(freed)
+    return f"File '{filename}' deleted."
+
+def com_PUSH(username, args):
+    """
+    Check that username may push a file: it is new, or they own it. Returns the filename to receive into
+    """
+    filename = args[0]
+    meta = metadataStore.get(filename)
+    if meta is not None and username != meta["owner"]:
+        raise CommandError("Permission denied. You cannot overwrite a file you do not own.")
+    # File does not exist, or the owner is overwriting their own file, so it can be received
+    return filename
+
+def isUpToDate(filename, filesize, checksum):
+    """True if the server's copy of filename already has this size and SHA-256, so a PUSH of it can be skipped"""
+    meta = metadataStore.get(filename)
+    return meta is not None and meta["filesize"] == filesize and meta.get("sha256") == checksum
+
+def com_GET(filename, offset=0, length=None):
+    """
+    Open a file to send to a client, from offset on and for at most length bytes (the rest of the file if None), so
+    an interrupted download can resume and a client can fetch just part of a file.
+    Returns the open file, the offset to stop sending at, the file's size and its SHA-256 (None for files uploaded
+    before checksums were recorded)
+    """
+    meta = metadataStore.get(filename)
+    if meta is not None and "blocks" in meta:
+        # Kept in the block store, the file is put back together from its blocks as it is sent
+        filehandle = BlockFile(blockStore, meta["blocks"], meta["blocksize"])
+        filesize = meta["filesize"]
+    else:
+        try:
+            # The file stays open for the whole transfer, every chunk is sent from this handle
+            filehandle = open(os.path.join(SERVER_FILE_PATH, filename), "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            raise CommandError(f"File '{filename}' does not exist.")
+        filesize = os.fstat(filehandle.fileno()).st_size
+    if offset > filesize:
+        filehandle.close()
+        raise CommandError(f"Error: Offset {offset} is past the end of '{filename}' ({filesize} bytes).")
+    end = filesize if length is None else min(filesize, offset + length)
+    return filehandle, end, filesize, meta.get("sha256") if meta else None
+
+def parseRange(tokens):
+    """Turns the "<offset> [<length>]" tokens of a ranged GET into (offset, length). Length is None if not given"""
+    if not 1 <= len(tokens) <= 2 or not all(token.isdigit() for token in tokens):
+        raise CommandError(f"Error: GET expects: {COMMANDS['GET']['signature']}")
+    offset = int(tokens[0])
+    length = int(tokens[1]) if len(tokens) == 2 else None
+    return offset, length
+
+def splitRange(argument):
+    """
+    v1: splits the argument of a GET into the filename and the "<offset> [<length>]" tokens of its range, if it
+    ends in "@<offset> [<length>]". Filenames may contain spaces and "@", so a name that exists as it is given is
+    never split.
+    """
+    filename, marker, rest = argument.rpartition(" @")
+    tokens = rest.split()
+    if not marker or not 1 <= len(tokens) <= 2 or not all(token.isdigit() for token in tokens):
+        return argument, []
+    if metadataStore.get(argument) is not None:
+        return argument, []
+    return filename, tokens
+
+def parseOptions(lines):
+    """
+    Turns the option lines of a v2 PUSH/GET/LIST ("<name> <values...>") into {name: [values]}.
+    Options the server does not know are left for the caller to ignore, so newer clients can still talk to it.
+    """
+    options = {}
+    for line in lines:
+        tokens = line.split()
+        if tokens:
+            options[tokens[0].lower()] = tokens[1:]
+    return options
+# end of Functions for each valid server command
+#-----------------------------
+
+#-----------------------------
+#
+# Functions for each step of a client session. They only look at and update the client's Connection and
+# return the reply for the client, so serverLoop and the asyncio server (asyncServerLoop) share them.
+#
+class Transfer:
+    """
+    One PUSH or GET running on a v2 connection. A v2 client can run several at once, their DATA frames carry
+    the request id of the PUSH/GET they belong to.
+    For a GET, sentbytes and filesize are positions in the file: a ranged GET starts part way in and can stop
+    short of the end.
+    A compressed transfer has a codec (a zlib/lzma compressor or decompressor). start is where in the file the
+    transfer began and wirebytes counts the bytes its DATA frames carried, for reporting what compression saved.
+    An upload keeps a running SHA-256 of the file in checksum, and the one the client sent (if any) in expected.
+    """
+    __slots__ = ("requestId", "filename", "filesize", "filehandle", "received", "sentbytes", "codec", "start",
+                 "wirebytes", "checksum", "expected", "began")
+
+    def __init__(self, requestId, filename):
+        self.requestId = requestId
+        self.filename = filename
+        self.filesize = None
+        self.filehandle = None
+        self.received = 0
+        self.sentbytes = 0
+        self.codec = None
+        self.start = 0
+        self.wirebytes = 0
+        self.checksum = None
+        self.expected = None
+        self.began = time.perf_counter()    # When the PUSH/GET arrived, for STATS
+
+def login(conn, username):
+    """Logs the client in as username. Returns the reply for the client"""
+    conn.username = username    # Store username
+    conn.state = ClientState.WAITING
+    print(f"User {username} logged in from {conn.addr}\n")
+    return f"Logged in as {username}.\nAvailable commands: PUSH <file>, GET <file>, LIST, DELETE <file>, STATS"
+
+def loginCommand(conn, line):
+    """
+    Handles a line from a client that has not logged in yet. Returns the reply for the client.
+    A client can ask for the binary protocol with "PROTO 2" here, everything after the reply is then sent in frames.
+    """
+    command_line = line.decode("utf-8").strip()
+    tokens = command_line.split(" ", 1)
+    # Try to log them in if they send a login command
+    if len(tokens) == 2 and tokens[0].upper() == "LOGIN":
+        started = time.perf_counter()
+        message = login(conn, tokens[1].strip()) + "\n"
+        recordCommand("LOGIN", started)
+        return message
+    if len(tokens) == 2 and tokens[0].upper() == "PROTO":
+        if tokens[1].strip() != str(PROTOCOL_VERSION):
+            return f"Error: Unsupported protocol version {tokens[1].strip()}.\n"
+        conn.protocol = PROTOCOL_VERSION
+        return f"PROTO {PROTOCOL_VERSION} OK\n"
+    return f"Error: You must login first with: {COMMANDS['LOGIN']['signature']}\n"
+
+def runCommand(conn, line):
+    """
+    Runs a command from a logged in client and returns the reply for the client, or None if there is nothing to reply.
+    PUSH and GET only prepare a transfer, moving the client into the state that carries it out.
+    """
+    receivedCommand = line.decode("utf-8").strip()
+    if receivedCommand in ("CONTINUE", "DONE"):
+        return None # Leftover acknowledgement from a download that has already been fully sent
+    tokens = receivedCommand.split(" ", 1)
+    username = conn.username
+
+    command = tokens[0].upper()
+    args = tokens[1:] # args is a list in case we feel like adding more arguments to some commands later
+    message = ""
+    started = time.perf_counter()
+    failed = False
+    try:
+        match command:
+            case "LOGIN":
+                message = "You are already logged in."
+            case "LIST":
+                # Options come as name=value arguments: LIST prefix=report limit=50
+                options = {}
+                for token in args[0].split() if args else []:
+                    name, _, value = token.partition("=")
+                    options[name.lower()] = [value]
+                message = com_LIST(parseListOptions(options))
+            case "DELETE":
+                message = com_DELETE(username, args)
+            case "PUSH":
+                # Prepare the server to receive a file from client
+                conn.filename = com_PUSH(username, args)
+                conn.filesize = None
+                conn.began = time.perf_counter()
+                conn.state = ClientState.RECEIVING_FILE_SIZE
+                message = "READY"
+                print(f"Receiving file {conn.filename} from {username} on {conn.addr}\n")
+            case "GET":
+                # Prepare the server to send a file to client. A ranged GET ends in "@<offset> [<length>]"
+                filename, rangeTokens = splitRange(args[0] if args else "")
+                offset, length = parseRange(rangeTokens) if rangeTokens else (0, None)
+                conn.filehandle, conn.filesize, total, _ = com_GET(filename, offset, length)
+                conn.filename = filename
+                conn.sentbytes = offset     # sentbytes and filesize are where in the file to start and stop
+                conn.start = offset
+                conn.began = time.perf_counter()
+                conn.state = ClientState.SENDING_FILE_SIZE
+                if rangeTokens:
+                    message = f"READY {filename} {conn.filesize - offset} {offset} {total}"
+                else:
+                    message = f"READY {filename} {total}"
+                print(f"Sending file {filename} to {username} on {conn.addr}\n")
+            case "STATS":
+                message = com_STATS()
+            case _:
+                message = "Error: Command does not exist."
+                command = "UNKNOWN"
+    except CommandError as e:
+        message = str(e)
+        failed = True
+    recordCommand(command, started, failed)
+    return message + "\n"
+
+def packFrame(opcode, requestId, payload=b""):
+    """Builds a v2 frame. A str payload is sent as utf-8"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return FRAME_HEADER.pack(opcode, requestId, len(payload)) + payload
+
+def runFrame(conn, opcode, requestId, payload):
+    """
+    v2: runs the command in a frame from the client and returns the reply frames as bytes.
+    PUSH and GET start a Transfer (conn.uploads / conn.downloads) and answer READY, their DATA frames follow while
+    the client carries on with other commands.
+    """
+    text = payload.decode("utf-8", "replace")
+    started = time.perf_counter()
+    failed = False
+    try:
+        if conn.state == ClientState.LOGGED_OUT:
+            if opcode != Opcode.LOGIN or not text:
+                raise CommandError(f"Error: You must login first with: {COMMANDS['LOGIN']['signature']}")
+            return packFrame(Opcode.OK, requestId, login(conn, text))
+        if opcode in (Opcode.PUSH, Opcode.GET):
+            if requestId in conn.uploads or any(t.requestId == requestId for t in conn.downloads):
+                raise CommandError(f"Error: Request id {requestId} is already in use.")
+            if len(conn.uploads) + len(conn.downloads) >= MAX_TRANSFERS:
+                raise CommandError(f"Error: No more than {MAX_TRANSFERS} transfers can run at once.")
+        match opcode:
+            case Opcode.LOGIN:
+                message = "You are already logged in."
+            case Opcode.LIST:
+                message = com_LIST(parseListOptions(parseOptions(text.split("\n"))))
+            case Opcode.DELETE:
+                message = com_DELETE(conn.username, [text])
+            case Opcode.SUBSCRIBE:
+                message = subscribe(conn, requestId)
+            case Opcode.STATS:
+                message = com_STATS()
+            case Opcode.PUSH:
+                header, *optionLines = text.split("\n")
+                filesize, _, filename = header.partition(" ")
+                if not filesize.isdigit() or not filename:
+                    raise CommandError("Error: PUSH expects <filesize> <filename>.")
+                options = parseOptions(optionLines)
+                compression = parseCompression(options["compress"]) if "compress" in options else None
+                transfer = Transfer(requestId, com_PUSH(conn.username, [filename]))
+                if any(t.filename == transfer.filename for t in conn.uploads.values()):
+                    raise CommandError(f"Error: File '{filename}' is already being uploaded.")
+                if options.get("sha256"):
+                    transfer.expected = options["sha256"][0].lower()
+                    if isUpToDate(transfer.filename, int(filesize), transfer.expected):
+                        print(f"File {filename} from {conn.username} is unchanged, not receiving it\n")
+                        return packFrame(Opcode.OK, requestId, f"File '{filename}' is already up to date.")
+                print(f"Receiving file {filename} from {conn.username} on {conn.addr}\n")
+                # READY tells the client where to carry on from, if an earlier upload of the same content broke off
+                openUpload(transfer, int(filesize), conn.username, transfer.expected)
+                transfer.start = transfer.received
+                readyText = str(transfer.received)
+                if compression is not None:
+                    transfer.codec = newDecompressor(compression[0])
+                    readyText += f"\ncompress {compression[0]}"
+                conn.uploads[requestId] = transfer     # fullyStaged picks it up if there is nothing to wait for
+                return packFrame(Opcode.READY, requestId, readyText)
+            case Opcode.GET:
+                # The payload is the filename. A ranged GET adds a "range <offset> [<length>]" line
+                filename, *optionLines = text.split("\n")
+                options = parseOptions(optionLines)
+                offset, length = parseRange(options["range"]) if "range" in options else (0, None)
+                compression = parseCompression(options["compress"]) if "compress" in options else None
+                transfer = Transfer(requestId, filename)
+                transfer.filehandle, transfer.filesize, total, checksum = com_GET(filename, offset, length)
+                transfer.sentbytes = transfer.start = offset
+                print(f"Sending file {filename} to {conn.username} on {conn.addr}\n")
+                if "range" in options:
+                    readyText = f"{transfer.filesize - offset} {offset} {total}"
+                else:
+                    readyText = str(total)
+                if checksum is not None:
+                    readyText += f"\nsha256 {checksum}"
+                # Content that is compressed already is sent as it is, the client sees no "compress" in READY
+                if compression is not None and transfer.sentbytes < transfer.filesize and not isCompressed(filename):
+                    transfer.codec = newCompressor(*compression)
+                    readyText += f"\ncompress {compression[0]}"
+                ready = packFrame(Opcode.READY, requestId, readyText)
+                if transfer.sentbytes == transfer.filesize:
+                    return ready + endDownload(transfer)
+                conn.downloads.append(transfer)     # Its DATA frames are sent whenever the socket is writable
+                return ready
+            case _:
+                message = "Error: Command does not exist."
+    except CommandError as e:
+        failed = True
+        return packFrame(Opcode.ERROR, requestId, str(e))
+    finally:
+        recordCommand(OPCODE_NAMES.get(opcode, "UNKNOWN"), started, failed)
+    return packFrame(Opcode.OK, requestId, message)
+
+def stagingPath(owner, filename, filesize, checksum=None):
+    """
+    Where an upload is staged. Pushing the same file (owner, name, size and the SHA-256 the client sent) again
+    finds the same staging file, so what is staged there is always part of the same content
+    """
+    key = hashlib.sha256(f"{owner}\n{filename}\n{filesize}\n{checksum}".encode("utf-8")).hexdigest()
+    return os.path.join(STAGING_PATH, f"{key}.part")
+
+def openStagingFile(path):
+    """
+    Opens a staging file for appending and locks it, so two uploads of the same file cannot write into it at once
+    (other processes included, for --workers). Raises CommandError if it is locked.
+    """
+    while True:
+        filehandle = open(path, "ab")
+        if fcntl is None:
+            return filehandle
+        try:
+            fcntl.flock(filehandle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            filehandle.close()
+            raise CommandError("Error: This file is already being uploaded.")
+        try:
+            if os.stat(path).st_ino == os.fstat(filehandle.fileno()).st_ino:
+                return filehandle
+        except FileNotFoundError:
+            pass
+        filehandle.close()  # The upload we waited on was just committed and moved away, stage a new one
+
+def openUpload(transfer, filesize, owner, checksum=None):
+    """
+    Opens the staging file to receive a PUSH of filesize bytes into. transfer is a v1 Connection or a v2 Transfer.
+    With the SHA-256 the client sent (checksum), whatever an interrupted upload of the same content left in the
+    staging file is kept and transfer.received says where the client has to carry on from. Without one there is
+    no telling what is staged apart from other content of the same size, so the upload starts from scratch.
+    """
+    transfer.filesize = filesize
+    filehandle = openStagingFile(stagingPath(owner, transfer.filename, filesize, checksum))
+    received = os.fstat(filehandle.fileno()).st_size
+    if checksum is None or received > filesize:
+        filehandle.truncate(0)
+        received = 0
+    transfer.filehandle = filehandle
+    transfer.received = received
+    transfer.checksum = hashlib.sha256()
+    if received:
+        with open(filehandle.name, "rb") as staged:    # What is staged already is part of the file's checksum
+            transfer.checksum = hashlib.file_digest(staged, "sha256")
+        print(f"File size: {filesize} bytes, resuming at {received}\n")
+    else:
+        print(f"File size: {filesize} bytes\n")
+
+def storeUpload(transfer):
+    """
+    The whole file of an upload has been received: make the staged file durable and move it to its place in one
+    step (os.replace). Until then the old version of the file, if any, is left alone. With the block store, the
+    staged file is split into blocks instead. Returns the file's block list (None for a whole file) for
+    commitUpload. This is the slow part of saving an upload and touches no metadata, so the asyncio server runs
+    it in a worker thread.
+    """
+    staged = transfer.filehandle.name
+    transfer.filehandle.flush()
+    if storageBackend == "blocks":
+        return blockStore.storeFile(staged)     # Other workers can carry on in the meantime, it takes no lock
+    os.fsync(transfer.filehandle.fileno())
+    if fcntl is None:
+        closeFilehandle(transfer)   # Without locks, an open file cannot be moved (Windows)
+    # Moved while still locked, so nobody can start writing into it in between
+    os.replace(staged, os.path.join(SERVER_FILE_PATH, transfer.filename))
+    return None
+
+def commitUpload(transfer, owner, blocks):
+    """
+    Records the metadata of an upload storeUpload has stored, with its block list (blocks). Returns the reply for
+    the client.
+    """
+    filename = transfer.filename
+    checksum = transfer.checksum.hexdigest()
+    with blockLock(metadataStore.get(filename)):
+        if storageBackend == "blocks":
+            blockStore.keepBlocks(transfer.filehandle.name, blocks)
+        freed = addMetadata(filename, owner, transfer.filesize, blocks, checksum)
+        if freed:
+            blockStore.free(freed)
+    print(f"File saved: {filename} (sha256 {checksum})")
+    return f"File '{filename}' uploaded successfully."
+
+def releaseUpload(transfer):
+    """
+    Closes the staged file of a committed upload. With the block store, where its content is in blocks now, the
+    staged file and any copy of the file from before the block store are removed.
+    """
+    if storageBackend == "blocks":
+        staged = transfer.filehandle.name
+        if fcntl is None:
+            closeFilehandle(transfer)   # Without locks, an open file cannot be removed (Windows)
+        os.remove(staged)   # Removed while still locked, so nobody can start writing into it in between
+        try:
+            os.remove(os.path.join(SERVER_FILE_PATH, transfer.filename))    # A copy from before the block store
+        except FileNotFoundError:
+            pass
+    closeFilehandle(transfer)
+
+def saveUpload(transfer, owner):
+    """Stores, commits and releases a fully received upload (v1 Connection or v2 Transfer). Returns the reply for the client"""
+    blocks = storeUpload(transfer)
+    message = commitUpload(transfer, owner, blocks)
+    releaseUpload(transfer)
+    return message
+
+def writeUpload(transfer, data):
+    """Writes file data of an upload (v1 Connection or v2 Transfer) to its staging file, adding it to its checksum"""
+    transfer.filehandle.write(data)
+    transfer.checksum.update(data)
+    transfer.received += len(data)
+
+def finishDownload(transfer):
+    """The whole file of a download has been sent: close it"""
+    # File sent
+    print(f"File sent: {transfer.filename}")
+    closeFilehandle(transfer)
+
+def receiveData(transfer, payload):
+    """
+    v2: writes the payload of a DATA frame to its upload, decompressing it first if the upload is compressed.
+    Returns True once the whole file has arrived. Raises ConnectionAbortedError if the client sends more than it
+    announced, or a compressed stream ends early.
+    """
+    transfer.wirebytes += len(payload)
+    pieces = (payload,) if transfer.codec is None else decompressPieces(transfer.codec, payload)
+    for piece in pieces:
+        if transfer.received + len(piece) > transfer.filesize:
+            raise ConnectionAbortedError(f"Client sent more than the {transfer.filesize} bytes of {transfer.filename}")
+        writeUpload(transfer, piece)
+    if transfer.codec is None:
+        return transfer.received >= transfer.filesize
+    if transfer.codec.eof and transfer.received < transfer.filesize:
+        raise ConnectionAbortedError(f"Compressed stream of {transfer.filename} ended before the whole file")
+    return transfer.codec.eof   # The end of the stream comes after the last of the file, wait for it
+
+def checkUpload(conn, transfer):
+    """
+    v2: if a fully received upload does not match the SHA-256 the client sent, throws it away, staged part and
+    all, so pushing it again starts from scratch, and returns its ERROR frame. Returns None if it is intact.
+    """
+    if transfer.expected is None or transfer.checksum.hexdigest() == transfer.expected:
+        return None
+    print(f"Error: {transfer.filename} does not match the checksum {conn.username} sent, discarding it\n")
+    staged = transfer.filehandle.name
+    closeFilehandle(transfer)
+    os.remove(staged)
+    return packFrame(Opcode.ERROR, transfer.requestId,
+                     f"Error: File '{transfer.filename}' did not arrive intact, please push it again.")
+
+def finishUpload(conn, transfer):
+    """v2: checks and saves a fully received upload. Returns its reply frame"""
+    return checkUpload(conn, transfer) or uploadSaved(conn, transfer, saveUpload(transfer, conn.username))
+
+def uploadSaved(conn, transfer, message):
+    """
+    v2: the OK frame of a saved upload, message being saveUpload's reply. A compressed upload's reply says what
+    it saved.
+    """
+    received = transfer.received - transfer.start
+    print(f"Received {received} bytes of {transfer.filename}, {transfer.wirebytes} on the wire\n")
+    recordTransfer("upload", transfer.began, received, transfer.wirebytes)
+    if transfer.codec is not None:
+        message += f" {received} bytes were sent as {transfer.wirebytes}."
+    return packFrame(Opcode.OK, transfer.requestId, message)
+
+def fullyStaged(conn, opcode, requestId):
+    """
+    v2: after a PUSH, returns its Transfer if all of the file was staged already by an earlier upload that broke
+    off, taking it off conn.uploads. No DATA frame will come for it, the caller finishes it straight away.
+    """
+    transfer = conn.uploads.get(requestId) if opcode == Opcode.PUSH else None
+    if transfer is None or transfer.received < transfer.filesize:
+        return None
+    del conn.uploads[requestId]
+    return transfer
+
+def nextFrameData(transfer):
+    """
+    v2: reads the payload of the next DATA frame of a download, up to FRAME_DATA_SIZE bytes of the file, compressed
+    if the download is. A compressor may hold on to what it was given, so it is fed until it has something to send.
+    Raises ConnectionAbortedError if the file shrank, the client was promised more than there is.
+    """
+    data = b""
+    while not data and transfer.sentbytes < transfer.filesize:
+        chunk = readChunk(transfer.filehandle, transfer.sentbytes, min(FRAME_DATA_SIZE, transfer.filesize - transfer.sentbytes))
+        if not chunk:
+            raise ConnectionAbortedError(f"{transfer.filename} shrank during a download")
+        transfer.sentbytes += len(chunk)
+        if transfer.codec is None:
+            data = chunk
         else:
-            message = f"Permission denied. You are not the owner of this file."
-    except Exception:
-        message = f"Error: File '{filename}' not found."
+            data = transfer.codec.compress(chunk)
+            if transfer.sentbytes >= transfer.filesize:
+                data += transfer.codec.flush()
+    transfer.wirebytes += len(data)
+    return data
+
+def endDownload(transfer):
+    """v2: closes a fully sent download and returns its END frame, which carries its file and wire byte counts"""
+    finishDownload(transfer)
+    sent = transfer.sentbytes - transfer.start
+    print(f"Sent {sent} bytes of {transfer.filename}, {transfer.wirebytes} on the wire\n")
+    recordTransfer("download", transfer.began, sent, transfer.wirebytes)
+    return packFrame(Opcode.END, transfer.requestId, f"{sent} {transfer.wirebytes}")
+
+def beginUpload(conn, line):
+    """Handles the file size line of a PUSH: opens the file to receive into. Returns the reply for the client"""
+    try:
+        filesize = int(line.decode("utf-8").strip())
+    except ValueError:
+        conn.state = ClientState.WAITING
+        return "Error: Invalid filesize.\n"
+    try:
+        openUpload(conn, filesize, conn.username)
+    except CommandError as e:
+        conn.state = ClientState.WAITING
+        return f"{e}\n"
+    conn.state = ClientState.RECEIVING_FILE
+    return "OK\n"
+
+def completeUpload(conn, message):
+    """
+    The whole file has been received and saved, message being saveUpload's reply: get the client ready for its next
+    command. Returns the reply for the client
+    """
+    recordTransfer("upload", conn.began, conn.received, conn.received)
+
+    # Clean up states
+    conn.state = ClientState.WAITING
+    conn.filename = None
+    conn.filesize = None
     return message
-# end of Functions for each valid server command
+
+def beginDownload(conn, line):
+    """Handles the client's answer to the READY of a GET. Returns the reply for the client"""
+    if line.strip().decode("utf-8") == "OK":
+        conn.state = ClientState.SENDING_FILE
+        conn.streaming = False
+        return "SERVER OK\n"
+    closeFilehandle(conn)
+    conn.state = ClientState.WAITING
+    return "Error: Expected OK\n"
+
+def completeDownload(conn):
+    """The whole file has been sent: close it and get the client ready for its next command"""
+    finishDownload(conn)
+    recordTransfer("download", conn.began, conn.filesize - conn.start, conn.filesize - conn.start)
+    # Clean up states
+    conn.state = ClientState.WAITING
+    conn.filename = None
+    conn.filesize = None
+    conn.sentbytes = 0
+    conn.streaming = False
+# end of Functions for each step of a client session
 #-----------------------------
 
-def setupSocket():
-    """Set up and return a listening server socket."""
+def setupSocket(reusePort=False):
+    """
+    Set up and return a listening server socket.
+    With reusePort, several worker processes can each bind their own socket to the same port.
+    """
     try:
         serverSocket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
         serverSocket.setsockopt(sock.SOL_SOCKET, sock.SO_REUSEADDR, 1)
+        if reusePort:
+            serverSocket.setsockopt(sock.SOL_SOCKET, sock.SO_REUSEPORT, 1)
         serverSocket.bind((HOST, PORT))
-        serverSocket.listen()
+        serverSocket.listen(SERVER_BACKLOG)
         serverSocket.setblocking(False)
         print(f"Server listening on {HOST}:{PORT}\n")
         return serverSocket
@@ -209,302 +1752,794 @@ def setupSocket():
         print(f"Server failed to start on {HOST}:{PORT}\nError: {e}")
         sys.exit(1)
 
-def newConnection(serverSocket, myClients, clientStates, clientBuffers):
+def raiseFileLimit():
     """
-    Accept a new incoming connection to the server socket. Sets client state and buffers to defaults.
-    Sends a welcome message to client
+    Every connected client holds a file descriptor, so raise the soft open-file limit as far as the hard limit allows.
+    The default of 1024 on most systems would otherwise cap the number of clients.
     """
-    conn, addr = serverSocket.accept()
-    print(f"Connection from {addr}\n")
-    myClients.append(conn)
-    clientStates[conn] = {"state": ClientState.LOGGED_OUT}   # Set client to default state
-    clientBuffers[conn] = b""   # Set client's buffer to empty
-    conn.sendall(f"Welcome to TreeDrive - Please login with: {COMMANDS['LOGIN']['signature']}\n".encode("utf-8"))
+    if resource is None:    # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > MAX_OPEN_FILES:
+        hard = MAX_OPEN_FILES
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            print(f"Error: Could not raise the open file limit: {e}")
 
-def clientDisconnect(clientSocket, myClients, clientStates, clientBuffers, loggedInClients):
+class Connection:
     """
-    Handle a disconnect of a client from the socket. Removes their states and buffers and logged them out if logged in.
+    Everything the server keeps about one connected client. It is registered with the selector as the data
+    of the client's socket, so each ready socket comes back with its state attached.
     """
-    try:    #need to check try in case the client disconnected immediately
-        addr = clientSocket.getpeername()
-    except:
-        addr = "unknown"
-
-    if clientSocket in loggedInClients:
-        username = loggedInClients.pop(clientSocket) # If client was logged in, remove from logged in clients
-        print(f"Removing client {username} {addr}\n")
-    else:
-        print(f"Removing client {addr}\n")
+    __slots__ = ("sock", "addr", "state", "username", "buffer", "outbox", "events", "closed",
+                 "protocol", "filename", "filesize", "filehandle", "received", "sentbytes", "streaming", "checksum",
+                 "uploads", "downloads", "frameHeader", "frameRemaining", "subscription", "notify", "start", "began")
+
+    def __init__(self, clientSocket, addr):
+        self.sock = clientSocket
+        self.addr = addr
+        self.state = ClientState.LOGGED_OUT
+        self.username = None            # Set once the client logs in
+        self.buffer = bytearray()       # Received bytes that have not been processed yet
+        self.outbox = deque()           # Data waiting for the socket to be writable
+        self.events = selectors.EVENT_READ
+        self.closed = False
+        self.protocol = 1               # Line based text protocol until the client asks for PROTO 2
+        # Current upload/download (v1)
+        self.filename = None
+        self.filesize = None
+        self.filehandle = None
+        self.received = 0
+        self.sentbytes = 0
+        self.streaming = False
+        self.checksum = None            # Running SHA-256 of the upload
+        self.start = 0                  # Where in the file the transfer began, and when (time.perf_counter()), for STATS
+        self.began = 0.0
+        # Running transfers (v2)
+        self.uploads = {}               # Request id -> Transfer
+        self.downloads = deque()        # Transfers to send, taking turns one DATA frame at a time
+        self.frameHeader = None         # Unsent part of the header of the DATA frame being sent
+        self.frameRemaining = 0         # Bytes of the DATA frame being sent still to go, other data waits until then
+        # File change events (v2 SUBSCRIBE)
+        self.subscription = None        # Request id of the client's SUBSCRIBE
+        self.notify = None              # Sends a frame to the client from outside its own session, set by the server loop
+
+def newConnection(selector, serverSocket):
+    """
+    Accept new incoming connections to the server socket. Registers each client with its own Connection state.
+    Sends a welcome message to client
+    """
+    while True:     # Drain the whole accept queue, connections tend to arrive in bursts
+        try:
+            clientSocket, addr = serverSocket.accept()
+        except BlockingIOError:
+            return
+        clientSocket.setblocking(False)     # Sends go through the client's outbox, so they never stall the loop
+        print(f"Connection from {addr}\n")
+        conn = Connection(clientSocket, addr)
+        conn.notify = lambda frame, conn=conn: queueNotification(conn, frame)
+        liveConnections.add(conn)
+        metrics.count("connections_total")
+        selector.register(clientSocket, conn.events, conn)
+        queueSend(conn, f"Welcome to TreeDrive - Please login with: {COMMANDS['LOGIN']['signature']}\n".encode("utf-8"))
+        updateInterest(selector, conn)
+
+def queueSend(conn, data):
+    """
+    Queues data on the client's outbound queue and sends as much of the queue as the socket takes right now.
+    Whatever does not fit is sent by serverLoop once the socket is writable again.
+    """
+    conn.outbox.append(data)
+    flushOutbox(conn)
 
-    # Clean Up
-    clientSocket.close()
-    myClients.remove(clientSocket)
-    clientStates.pop(clientSocket)
-    clientBuffers.pop(clientSocket)
+notifiedConnections = set()     # Clients sent an event while another client was handled, see queueNotification
 
-def handleClient(clientSocket, myClients, clientStates, clientBuffers, loggedInClients):
+def queueNotification(conn, frame):
     """
-    handleClient()
+    Queues a frame (a file change event) for a client other than the one being handled.
+    serverLoop registers it for write events afterwards if the frame did not go out at once.
+    """
+    queueSend(conn, frame)
+    notifiedConnections.add(conn)
 
-    Manages a client socket by receiving data from it and updating the clients buffer.
-    handleClient(...) manages the state of clients based on their inputs sent to the server.
-    handleClient(...) handles the processing of client command and pushes the socket to the correct state to handle concurrent requests.
+def flushOutbox(conn):
+    """
+    Sends queued data until the queue is empty or the socket would block. A partially sent message keeps its
+    unsent tail at the front of the queue. Returns True once the queue is empty.
+    Nothing is sent while a v2 DATA frame is part way out, it would land in the middle of the frame.
+    """
+    if conn.frameHeader is not None or conn.frameRemaining:
+        return False
+    outbox = conn.outbox
+    while outbox:
+        try:
+            sent = conn.sock.send(outbox[0])
+        except BlockingIOError:
+            return False
+        if sent < len(outbox[0]):
+            outbox[0] = memoryview(outbox[0])[sent:]
+            return False
+        outbox.popleft()
+    return True
+
+def wantsToWrite(conn):
+    """True if the client has queued data or a running download, meaning we should wait for it to be writable"""
+    return bool(conn.outbox) or bool(conn.downloads) or (conn.state == ClientState.SENDING_FILE and conn.streaming)
+
+def updateInterest(selector, conn):
+    """Registers the client for write events only while it has something to write"""
+    events = selectors.EVENT_READ
+    if wantsToWrite(conn):
+        events |= selectors.EVENT_WRITE
+    if events != conn.events and not conn.closed:
+        selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+def readChunk(filehandle, offset, count):
+    """Reads up to count bytes of filehandle (a file or a BlockFile), starting at offset"""
+    if isinstance(filehandle, BlockFile):
+        return filehandle.read(offset, count)
+    filehandle.seek(offset)
+    return filehandle.read(count)
+
+def sendFileChunk(clientSocket, filehandle, offset, count):
+    """
+    Sends up to count bytes of filehandle, starting at offset, to clientSocket without copying them through Python.
+    Uses os.sendfile where the OS has it. Elsewhere it falls back to reading the chunk and a plain send, since
+    socket.sendfile does not support non-blocking sockets. A BlockFile is sent from one block at a time.
+    Returns the number of bytes sent, raises BlockingIOError if the socket has no room.
+    """
+    if not hasattr(os, "sendfile"):
+        return clientSocket.send(readChunk(filehandle, offset, count))
+    if isinstance(filehandle, BlockFile):
+        fd, offset, available = filehandle.locate(offset)
+        count = min(count, available)
+    else:
+        fd = filehandle.fileno()
+    return os.sendfile(clientSocket.fileno(), fd, offset, count)
 
+def pumpDownload(conn):
     """
-    try:
-        data = clientSocket.recv(CHUNK_SIZE)
-        if not data:
-            clientDisconnect(clientSocket, myClients, clientStates, clientBuffers, loggedInClients)
+    Streams the client's download for as long as the socket takes more, up to SEND_BURST bytes per call so one
+    large download cannot starve other clients. Finishes the transfer once the whole file has been sent.
+    """
+    sent = None
+    sentNow = 0
+    while conn.sentbytes < conn.filesize and sentNow < SEND_BURST:
+        try:
+            sent = sendFileChunk(conn.sock, conn.filehandle, conn.sentbytes, min(CHUNK_SIZE, conn.filesize - conn.sentbytes))
+        except BlockingIOError:
             return
-        
-        clientBuffers[clientSocket] += data     #update buffers
+        if sent == 0:
+            break   # The file shrank underneath us, there is nothing more to send
+        conn.sentbytes += sent
+        sentNow += sent
 
-        client = clientStates[clientSocket]
-        buffer = clientBuffers[clientSocket]
-        # Get client current state
-        state = client["state"]
-
-
-
-        # Server says Client is LOGGED_OUT
-        if state == ClientState.LOGGED_OUT:
-            if b"\n" not in buffer: #wait for a full line
-                return
-            # We have received a full line, so pull the command_line out
-            line, remainder = buffer.split(b"\n", 1)
-            clientBuffers[clientSocket] = remainder #store remainder in the buffer
-            command_line = line.decode("utf-8").strip()
-            tokens = command_line.split(" ", 1)
-            # Try to log them in if they send a login command
-            if len(tokens) == 2 and tokens[0].upper() == "LOGIN":
-                username = tokens[1].strip()
-                loggedInClients[clientSocket] = username    # Store username
-                client["state"] = ClientState.WAITING
-                clientSocket.sendall(f"Logged in as {username}.\nAvailable commands: PUSH <file>, GET <file>, LIST, DELETE <file>\n".encode("utf-8"))
-                print(f"User {username} logged in from {clientSocket.getpeername()}\n")
-                return
-            else:
-                clientSocket.sendall(f"Error: You must login first with: {COMMANDS['LOGIN']['signature']}\n".encode("utf-8"))
-                return
+    if sent == 0 or conn.sentbytes >= conn.filesize:
+        completeDownload(conn)
 
-        # Server WAITING_FOR_COMMANDS
-        elif state == ClientState.WAITING:
-            if b"\n" not in buffer: #wait for a full line
+def pumpFrames(conn):
+    """
+    v2: sends the client's queued replies and the DATA frames of its running downloads for as long as the socket
+    takes more, up to SEND_BURST bytes per call. Downloads take turns one frame each, so a large file does not hold
+    up small ones. A frame is always sent whole before anything else goes out.
+    """
+    sentNow = 0
+    while True:
+        if conn.frameHeader is None and conn.frameRemaining == 0:  # In between frames
+            if not flushOutbox(conn) or not conn.downloads or sentNow >= SEND_BURST:
                 return
-            # We have received a full line, so pull the receivedCommand out
-            line, remainder = buffer.split(b"\n", 1)
-            clientBuffers[clientSocket] = remainder #store remainder in the buffer
-            receivedCommand = line.decode("utf-8").strip()
-            tokens = receivedCommand.split(" ", 1)
-            username = loggedInClients[clientSocket]
-
-            command = tokens[0].upper()
-            args = tokens[1:] # args is a list in case we feel like adding more arguments to some commands later
-            message = ""
-            match command:
-                case "LOGIN":
-                    message = "You are already logged in.\n"
-                case "LIST":
-                    message = com_LIST()
-                case "DELETE":
-                    message = com_DELETE(username, args) + "\n"
-                case "PUSH":
-                    # Prepare the server to receive a file from client
-                    filename = args[0]
-                    metadata = loadMetadata()
-
-                    if os.path.exists(f"{SERVER_FILE_PATH}/{filename}"):
-                        fileOwner = metadata[filename]["owner"]
-                        if username == fileOwner:
-                            # Owner tries to overwrite their file, this is allowed
-                            client["state"] = ClientState.RECEIVING_FILE_SIZE
-                            client["filename"] = filename
-                            client["filebytes"] = b""
-                            client["filesize"] = None
-                            message = "READY\n"
-                            print(f"Receiving file {filename} from {username} on {clientSocket.getpeername()}\n")
-                        else:
-                            message = "Permission denied. You cannot overwrite a file you do not own.\n"
-                    else:
-                        # File does not exist so it can be received
-                        client["state"] = ClientState.RECEIVING_FILE_SIZE
-                        client["filename"] = filename
-                        client["filebytes"] = b""
-                        client["filesize"] = None
-                        message = "READY\n"
-                        print(f"Receiving file {filename} from {username} on {clientSocket.getpeername()}\n")
-                case "GET":
-                    # Prepare the server to send a file to client
-                    filename = args[0]
-                    if os.path.exists(f"{SERVER_FILE_PATH}/{filename}"): # check if file exists
-                        filesize = os.path.getsize(f"{SERVER_FILE_PATH}/{filename}")
-                        client["state"] = ClientState.SENDING_FILE_SIZE
-                        client["filename"] = filename
-                        client["filesize"] = filesize
-                        client["sentbytes"] = 0
-                        message = f"READY {filename} {filesize}\n"
-                        print(f"Sending file {filename} to {username} on {clientSocket.getpeername()}\n")
-                    else:
-                        message = f"File '{filename}' does not exist."
-                case _:
-                    message = "Error: Command does not exist.\n"
+            transfer = conn.downloads[0]
+            if transfer.codec is not None:
+                # Compressed frames are built in memory, so they go out through the outbox
+                data = nextFrameData(transfer)
+                conn.outbox.append(packFrame(Opcode.DATA, transfer.requestId, data))
+                sentNow += len(data)
+                rotateDownloads(conn)
+                continue
+            conn.frameRemaining = min(FRAME_DATA_SIZE, transfer.filesize - transfer.sentbytes)
+            conn.frameHeader = FRAME_HEADER.pack(Opcode.DATA, transfer.requestId, conn.frameRemaining)
 
-            clientSocket.sendall(f"{message}".encode("utf-8"))
+        try:
+            if conn.frameHeader is not None:
+                sent = conn.sock.send(conn.frameHeader)
+                conn.frameHeader = conn.frameHeader[sent:] or None
+                if conn.frameHeader is not None:
+                    return
+            transfer = conn.downloads[0]
+            sent = sendFileChunk(conn.sock, transfer.filehandle, transfer.sentbytes, conn.frameRemaining)
+        except BlockingIOError:
+            return
+        if sent == 0:
+            # The file shrank underneath us. The frame already announced its length, so it cannot be completed
+            raise ConnectionAbortedError(f"{transfer.filename} shrank during a download")
+        transfer.sentbytes += sent
+        transfer.wirebytes += sent
+        conn.frameRemaining -= sent
+        sentNow += sent
+
+        if conn.frameRemaining == 0:
+            rotateDownloads(conn)
+
+def rotateDownloads(conn):
+    """
+    v2: the first of the client's downloads has sent a frame. Queues its END if that was the last of it,
+    otherwise moves it to the back so the next download gets a turn.
+    """
+    transfer = conn.downloads.popleft()
+    if transfer.sentbytes >= transfer.filesize:
+        conn.outbox.append(endDownload(transfer))
+    else:
+        conn.downloads.append(transfer)
+
+def closeFilehandle(conn):
+    """Closes the file a client (or one of its Transfers) is uploading or downloading, if it has one open"""
+    if conn.filehandle:
+        conn.filehandle.close()
+        conn.filehandle = None
+
+def closeTransfers(conn):
+    """Closes the files of all of the client's transfers"""
+    closeFilehandle(conn)
+    for transfer in [*conn.uploads.values(), *conn.downloads]:
+        closeFilehandle(transfer)
+    conn.uploads.clear()
+    conn.downloads.clear()
+
+def clientDisconnect(selector, conn):
+    """
+    Handle a disconnect of a client from the socket. Unregisters it, which drops its state, and logs it out if logged in.
+    """
+    if conn.closed:
+        return
+    if conn.username is not None:
+        print(f"Removing client {conn.username} {conn.addr}\n")
+    else:
+        print(f"Removing client {conn.addr}\n")
 
-        # Client has said it will be sending a file, server now wants the file size
-        elif client["state"] == ClientState.RECEIVING_FILE_SIZE:
-            if b"\n" not in buffer: #wait for a full line
-                return
-            # We have received a full line, so pull the receivedCommand out
-            line, remainder = buffer.split(b"\n", 1)
-            clientBuffers[clientSocket] = remainder #store remainder in the buffer
-            try:
-                filesize = int(line.decode("utf-8").strip())
-                client["filesize"] = filesize
-                client["received"] = 0
-
-                filename = client["filename"]
-                # Save the received file
-                filePath = os.path.join(SERVER_FILE_PATH, filename)
-                client["filehandle"] = open(filePath, "wb") # Open file here for writing
-
-                clientSocket.sendall(b"OK\n")
-                client["state"] = ClientState.RECEIVING_FILE
-                print(f"File size: {filesize} bytes\n")
-            except ValueError:
-                clientSocket.sendall(b"Error: Invalid filesize.\n")
-                client["state"] = ClientState.WAITING
-
-        # Client has sent the filesize, server now waiting on the file
-        elif client["state"] == ClientState.RECEIVING_FILE:
-
-            remaining = client["filesize"] - client["received"]
-            to_write = data[:remaining]
-            client["filehandle"].write(to_write)
-            client["received"] += len(to_write)
-
-            if client["received"] < client["filesize"]:
-                return # Still more to receive
-            
+    # Clean Up
+    closeTransfers(conn)
+    unsubscribe(conn)
+    liveConnections.discard(conn)
+    selector.unregister(conn.sock)
+    conn.sock.close()
+    conn.closed = True
+
+def takeLine(conn):
+    """Pulls the next full line out of the client's buffer, or returns None if a full line has not arrived yet"""
+    end = conn.buffer.find(b"\n")
+    if end == -1:
+        return None
+    line = bytes(conn.buffer[:end])
+    del conn.buffer[:end + 1]
+    return line
+
+def takeFrame(conn):
+    """
+    v2: pulls the next full frame out of the client's buffer as (opcode, requestId, payload), or returns None if a
+    full frame has not arrived yet
+    """
+    if len(conn.buffer) < FRAME_HEADER.size:
+        return None
+    opcode, requestId, length = FRAME_HEADER.unpack_from(conn.buffer)
+    if length > FRAME_MAX_SIZE:
+        raise ConnectionAbortedError(f"{conn.addr} sent a {length} byte frame, more than {FRAME_MAX_SIZE}")
+    end = FRAME_HEADER.size + length
+    if len(conn.buffer) < end:
+        return None
+    payload = bytes(conn.buffer[FRAME_HEADER.size:end])
+    del conn.buffer[:end]
+    return opcode, requestId, payload
+
+def processFrame(conn):
+    """
+    v2 counterpart of processBuffer: handles the next frame in the client's buffer.
+    Returns True if it consumed a frame, so the caller knows to call again for whatever is left.
+    """
+    frame = takeFrame(conn)
+    if frame is None: #wait for a full frame
+        return False
+    opcode, requestId, payload = frame
+
+    # File data of an upload
+    if opcode == Opcode.DATA:
+        transfer = conn.uploads.get(requestId)
+        if transfer is None:
+            return True     # Data of an upload that was refused, drop it
+        if receiveData(transfer, payload):
             # File fully received
-            client["filehandle"].close()
-            client["filehandle"] = None
+            del conn.uploads[requestId]
+            queueSend(conn, finishUpload(conn, transfer))
+        return True
 
-            filename = client["filename"]
-            addMetadata(filename, owner=loggedInClients[clientSocket])
+    queueSend(conn, runFrame(conn, opcode, requestId, payload))
+    transfer = fullyStaged(conn, opcode, requestId)
+    if transfer is not None:
+        queueSend(conn, finishUpload(conn, transfer))
+    return True
 
-            clientSocket.sendall(f"File '{filename}' uploaded successfully.\n".encode("utf-8"))
-
-            print(f"File saved: {filename}")
-
-            # Clean up states
-            client["state"] = ClientState.WAITING
-            client["filename"] = None
-            client["filesize"] = None
-            client["filebytes"] = b""
+def processBuffer(conn):
+    """
+    Advances the client's state machine using what is in its buffer.
+    Returns True if it consumed something, so the caller knows to call again for whatever is left.
+    """
+    # Client switched to the binary protocol
+    if conn.protocol != 1:
+        return processFrame(conn)
+
+    # Server says Client is LOGGED_OUT
+    if conn.state == ClientState.LOGGED_OUT:
+        line = takeLine(conn)
+        if line is None: #wait for a full line
+            return False
+        queueSend(conn, loginCommand(conn, line).encode("utf-8"))
+        return True
+
+    # Server WAITING_FOR_COMMANDS
+    elif conn.state == ClientState.WAITING:
+        line = takeLine(conn)
+        if line is None: #wait for a full line
+            return False
+        message = runCommand(conn, line)
+        if message is not None:
+            queueSend(conn, message.encode("utf-8"))
+        return True
+
+    # Client has said it will be sending a file, server now wants the file size
+    elif conn.state == ClientState.RECEIVING_FILE_SIZE:
+        line = takeLine(conn)
+        if line is None: #wait for a full line
+            return False
+        queueSend(conn, beginUpload(conn, line).encode("utf-8"))
+        if conn.state == ClientState.RECEIVING_FILE and conn.filesize == 0:
+            queueSend(conn, (completeUpload(conn, saveUpload(conn, conn.username)) + "\n").encode("utf-8"))  # Nothing to wait for
+        return True
+
+    # Client has sent the filesize, server now waiting on the file
+    elif conn.state == ClientState.RECEIVING_FILE:
+        count = min(conn.filesize - conn.received, len(conn.buffer))
+        with memoryview(conn.buffer) as view:
+            writeUpload(conn, view[:count])
+        del conn.buffer[:count]
+
+        if conn.received >= conn.filesize:
+            # File fully received
+            queueSend(conn, (completeUpload(conn, saveUpload(conn, conn.username)) + "\n").encode("utf-8"))
+        return True
+
+    # Client has been sent the file size
+    elif conn.state == ClientState.SENDING_FILE_SIZE:
+        line = takeLine(conn)
+        if line is None: #wait for a full line
+            return False
+        queueSend(conn, beginDownload(conn, line).encode("utf-8"))
+        return True
+
+    # Client has requested a file download
+    elif conn.state == ClientState.SENDING_FILE:
+        # Anything from the client here is its go-ahead (or a CONTINUE from an older client). The file is then
+        # streamed whenever the socket is writable, without waiting on the client in between chunks.
+        conn.buffer.clear()
+        if not conn.streaming:
+            conn.streaming = True
+            if flushOutbox(conn):
+                pumpDownload(conn)
+        return False
+
+    return False
+
+def handleClient(selector, conn):
+    """
+    handleClient()
 
-        # Client has been sent the file size
-        elif client["state"] == ClientState.SENDING_FILE_SIZE:
-            if b"\n" not in buffer: #wait for a full line
-                return
-            # We have received a full line, so pull the receivedCommand out
-            line, remainder = buffer.split(b"\n", 1)
-            clientBuffers[clientSocket] = remainder #store remainder in the buffer
-            if line.strip().decode("utf-8") == "OK":
-                client["state"] = ClientState.SENDING_FILE
-                clientSocket.sendall(b"SERVER OK\n")
-            else:
-                clientSocket.sendall("Error: Expected OK\n".encode("utf-8"))
-                client["state"] = ClientState.WAITING
+    Manages a client socket by receiving data from it and updating the clients buffer.
+    handleClient(...) then runs the client's state machine (processBuffer) over everything that has arrived, so several
+    commands sent back to back are all handled.
+    """
+    try:
+        data = conn.sock.recv(CHUNK_SIZE)
+        if not data:
+            clientDisconnect(selector, conn)
+            return
 
-        # Client has requested a file download
-        elif client["state"] == ClientState.SENDING_FILE:
-            try:
-                # Open the file for reading bytes
-                filepath = os.path.join(SERVER_FILE_PATH, client["filename"])
-                with open(filepath, "rb") as f:
-                    f.seek(client["sentbytes"])
-                    packet = f.read(CHUNK_SIZE)
-                    if packet:
-                        clientSocket.sendall(packet)
-                        client["sentbytes"] += len(packet)
-                    else:
-                        # File sent
-                        print(f"File sent: {client['filename']}")
-                        # Clean up states
-                        clientBuffers[clientSocket] = b""
-                        client["state"] = ClientState.WAITING
-                        client["filename"] = None
-                        client["filesize"] = None
-                        client["sentbytes"] = 0
-            except ConnectionResetError as e:
-                print(f"Client disconnected abrubtly.")
+        conn.buffer += data     #update buffers
+        while conn.buffer and processBuffer(conn):
+            pass
+        updateInterest(selector, conn)
     except (ConnectionResetError, BrokenPipeError):
-        clientDisconnect(clientSocket, myClients, clientStates, clientBuffers, loggedInClients)
+        clientDisconnect(selector, conn)
+    except ConnectionAbortedError as e:    # The client broke the protocol
+        print("Error:", e)
+        clientDisconnect(selector, conn)
     except Exception as e:
         print("Error:", e)
+        updateInterest(selector, conn)
 
+def handleWritable(selector, conn):
+    """
+    Called when a client's socket can take more data. Flushes the client's outbound queue, and once that is
+    empty keeps its download streaming.
+    """
+    try:
+        if conn.protocol != 1:
+            pumpFrames(conn)
+        elif flushOutbox(conn) and conn.state == ClientState.SENDING_FILE and conn.streaming:
+            pumpDownload(conn)
+        updateInterest(selector, conn)
+    except (ConnectionResetError, BrokenPipeError):
+        clientDisconnect(selector, conn)
+    except ConnectionAbortedError as e:
+        print("Error:", e)
+        clientDisconnect(selector, conn)
+    except Exception as e:
+        print("Error:", e)
 
 def serverLoop(serverSocket):
     """
-    Loop through the socket using a select statement to manage many sockets on a single-thread.
+    Loop over the ready sockets using a selector (epoll on Linux) to manage many sockets on a single-thread.
     Calls:
         newConnection(...) : when a new client connects.
         handleClient(...) : when an existing client is readable.
+        handleWritable(...) : when a client with queued data or a running download is writable.
         clientDisconnect(...) : when a client is disconnected through an exception.
     """
-    myClients = []                  # Clients will come-and-go
-    loggedInClients = {}            # Maintain a dictionary of who is currently logged in
-    clientStates = {}               # Maintains the state of connected clients
-    clientBuffers =  {}             # Client Buffers to store received bytestrings
-    myReadables = [serverSocket, ]  # server socket should stay in myReadables as we want to maintain it
+    selector = selectors.DefaultSelector()
+    selector.register(serverSocket, selectors.EVENT_READ)    # No data, that is how we tell it apart from clients
+    timeout = SERVER_SELECT_TIMEOUT if lastChange is None else CHANGE_POLL_INTERVAL
+    polled = time.monotonic()
     while True:
         try:
-            readable, writeable, exceptions = select.select(
-                myReadables + myClients,
-                [],
-                myReadables + myClients,
-                SERVER_SELECT_TIMEOUT
-            )
-            for eachSocket in readable:
-                if eachSocket is serverSocket:  # New client (since serverSocket is in myReadable)
-                    newConnection(serverSocket, myClients, clientStates, clientBuffers)
-                else:                           # Existing Connection
-                    handleClient(eachSocket, myClients, clientStates, clientBuffers, loggedInClients)
-            for eachSocket in exceptions:
-                print(f"Error: sock is stinky")
-                clientDisconnect(eachSocket, myClients, clientStates, clientBuffers, loggedInClients)
+            ready = selector.select(timeout)
+            started = time.perf_counter()
+            if lastChange is not None and time.monotonic() - polled >= CHANGE_POLL_INTERVAL:
+                pollChanges()   # Changes made through the other workers
+                polled = time.monotonic()
+            for key, events in ready:
+                conn = key.data
+                if conn is None:                # New client (the server socket is the only one without a Connection)
+                    newConnection(selector, serverSocket)
+                    continue
+                if events & selectors.EVENT_READ:
+                    handleClient(selector, conn)
+                if events & selectors.EVENT_WRITE and not conn.closed:  # It may have disconnected while we were reading
+                    handleWritable(selector, conn)
+            while notifiedConnections:      # Subscribers with an event that did not fit into their socket
+                conn = notifiedConnections.pop()
+                if not conn.closed:
+                    updateInterest(selector, conn)
+            if ready:
+                metrics.observe("loop_seconds", time.perf_counter() - started)
         except KeyboardInterrupt:
             print("Terminating server...")
-            for client in myClients:
-                client.close()
-            serverSocket.close()
+            for key in list(selector.get_map().values()):
+                if key.data is not None:
+                    closeTransfers(key.data)
+                key.fileobj.close()
+            selector.close()
+            metadataStore.close()
             sys.exit(0)
         except Exception as e:
             print("Unexpected Error. Time to get out the hammer!")
             print(f"Error: {e}")
 
+#-----------------------------
+#
+# asyncio server, an alternative to serverLoop selected with --asyncio.
+# Every client session is its own coroutine, running the same protocol through the same session steps.
+#
+async def asyncReceiveFile(conn, reader, writer):
+    """Receives the file size line and then the file of a PUSH, writing the file from a worker thread"""
+    line = await reader.readline()
+    if not line:
+        return
+    writer.write(beginUpload(conn, line).encode("utf-8"))
+    await writer.drain()
+    while conn.state == ClientState.RECEIVING_FILE and conn.received < conn.filesize:
+        data = await reader.read(min(CHUNK_SIZE, conn.filesize - conn.received))
+        if not data:
+            return  # Client went away part way through
+        await asyncio.to_thread(writeUpload, conn, data)
+    if conn.state == ClientState.RECEIVING_FILE:
+        message = await asyncSaveUpload(conn, conn.username)
+        writer.write((completeUpload(conn, message) + "\n").encode("utf-8"))
+
+async def asyncSendFile(conn, reader, writer):
+    """Waits for the client's OKs to the READY of a GET, then streams the file, reading it from a worker thread"""
+    line = await reader.readline()
+    if not line:
+        return
+    writer.write(beginDownload(conn, line).encode("utf-8"))
+    await writer.drain()
+    if conn.state != ClientState.SENDING_FILE:
+        return
+    if not await reader.readline():  # The client's go-ahead
+        return
+    while conn.sentbytes < conn.filesize:
+        packet = await asyncio.to_thread(readChunk, conn.filehandle, conn.sentbytes, min(CHUNK_SIZE, conn.filesize - conn.sentbytes))
+        if not packet:
+            break   # The file shrank underneath us, there is nothing more to send
+        writer.write(packet)
+        await writer.drain()    # Waits while the client is behind, instead of queueing the whole file in memory
+        conn.sentbytes += len(packet)
+    completeDownload(conn)
+
+async def asyncReadFrame(reader):
+    """v2: reads the next frame as (opcode, requestId, payload), or returns None once the client has gone"""
+    try:
+        opcode, requestId, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        if length > FRAME_MAX_SIZE:
+            raise ConnectionAbortedError(f"Client sent a {length} byte frame, more than {FRAME_MAX_SIZE}")
+        return opcode, requestId, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+async def asyncSaveUpload(transfer, owner):
+    """
+    saveUpload for the asyncio server. Storing and releasing the file run in a worker thread, recording its
+    metadata on the event loop, which the SQLite connection belongs to
+    """
+    blocks = await asyncio.to_thread(storeUpload, transfer)
+    message = commitUpload(transfer, owner, blocks)
+    await asyncio.to_thread(releaseUpload, transfer)
+    return message
+
+async def asyncFinishUpload(conn, transfer):
+    """v2: finishUpload for the asyncio server"""
+    error = checkUpload(conn, transfer)
+    if error is not None:
+        return error
+    return uploadSaved(conn, transfer, await asyncSaveUpload(transfer, conn.username))
+
+async def asyncReceiveData(conn, requestId, payload, writer):
+    """
+    v2: writes (and decompresses) the payload of a DATA frame to its upload from a worker thread, saving the file
+    once it is complete
+    """
+    transfer = conn.uploads.get(requestId)
+    if transfer is None:
+        return  # Data of an upload that was refused, drop it
+    if await asyncio.to_thread(receiveData, transfer, payload):
+        # File fully received
+        del conn.uploads[requestId]
+        writer.write(await asyncFinishUpload(conn, transfer))
+
+async def asyncSendFrames(conn, transfer, writer):
+    """
+    v2: streams the file of a GET as DATA frames followed by END, reading (and compressing) it from a worker thread.
+    Every running GET has one of these, they take turns whenever the client catches up (drain).
+    """
+    try:
+        while transfer.sentbytes < transfer.filesize:
+            packet = await asyncio.to_thread(nextFrameData, transfer)
+            writer.write(packFrame(Opcode.DATA, transfer.requestId, packet))
+            await writer.drain()
+        writer.write(endDownload(transfer))
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    except ConnectionAbortedError as e:
+        print("Error:", e)
+        writer.close()
+    finally:
+        closeFilehandle(transfer)
+        if transfer in conn.downloads:  # The session may already have closed it down
+            conn.downloads.remove(transfer)
+
+async def asyncFrameSession(conn, reader, writer):
+    """v2: the rest of a client session once it has switched to the binary protocol"""
+    sending = {}    # Transfer -> the task sending it
+    try:
+        while True:
+            await writer.drain()
+            frame = await asyncReadFrame(reader)
+            if frame is None:
+                return
+            opcode, requestId, payload = frame
+            if opcode == Opcode.DATA:
+                await asyncReceiveData(conn, requestId, payload, writer)
+                continue
+            writer.write(runFrame(conn, opcode, requestId, payload))
+            transfer = fullyStaged(conn, opcode, requestId)
+            if transfer is not None:
+                writer.write(await asyncFinishUpload(conn, transfer))
+            for transfer in conn.downloads:     # A GET that started gets a task of its own
+                if transfer not in sending:
+                    task = asyncio.create_task(asyncSendFrames(conn, transfer, writer))
+                    sending[transfer] = task
+                    task.add_done_callback(lambda _, transfer=transfer: sending.pop(transfer, None))
+    finally:
+        for task in list(sending.values()):
+            task.cancel()
+
+async def asyncSession(reader, writer):
+    """One client session, from the welcome message until the client disconnects"""
+    conn = Connection(None, writer.get_extra_info("peername"))
+    loop = asyncio.get_running_loop()
+    conn.notify = lambda frame: loop.call_soon_threadsafe(writer.write, frame)
+    liveConnections.add(conn)
+    metrics.count("connections_total")
+    print(f"Connection from {conn.addr}\n")
+    try:
+        writer.write(f"Welcome to TreeDrive - Please login with: {COMMANDS['LOGIN']['signature']}\n".encode("utf-8"))
+        while True:
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                break
+            if conn.state == ClientState.LOGGED_OUT:
+                writer.write(loginCommand(conn, line).encode("utf-8"))
+                if conn.protocol != 1:
+                    await asyncFrameSession(conn, reader, writer)
+                    break
+                continue
+            message = runCommand(conn, line)
+            if message is not None:
+                writer.write(message.encode("utf-8"))
+            if conn.state == ClientState.RECEIVING_FILE_SIZE:
+                await asyncReceiveFile(conn, reader, writer)
+            elif conn.state == ClientState.SENDING_FILE_SIZE:
+                await asyncSendFile(conn, reader, writer)
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    except asyncio.CancelledError:
+        pass    # The server is shutting down, the session is closed like any other. asyncio would report it otherwise
+    except Exception as e:     # Including ConnectionAbortedError, the client broke the protocol
+        print("Error:", e)
+    finally:
+        if conn.username is not None:
+            print(f"Removing client {conn.username} {conn.addr}\n")
+        else:
+            print(f"Removing client {conn.addr}\n")
+        closeTransfers(conn)
+        unsubscribe(conn)
+        liveConnections.discard(conn)
+        writer.close()
+
+async def asyncPollChanges():
+    """With --workers, runs pollChanges every CHANGE_POLL_INTERVAL seconds, on the event loop like the other metadata calls"""
+    while True:
+        await asyncio.sleep(CHANGE_POLL_INTERVAL)
+        pollChanges()
+
+async def asyncServe(reusePort=False):
+    """Listen on HOST:PORT and run a session coroutine for every client"""
+    if lastChange is not None:
+        poller = asyncio.create_task(asyncPollChanges())   # Kept referenced here, so it is not garbage collected
+    try:
+        server = await asyncio.start_server(asyncSession, HOST, PORT, backlog=SERVER_BACKLOG,
+                                            reuse_address=True, reuse_port=reusePort or None)
+    except Exception as e:
+        print(f"Server failed to start on {HOST}:{PORT}\nError: {e}")
+        sys.exit(1)
+    print(f"Server listening on {HOST}:{PORT} (asyncio)\n")
+    async with server:
+        await server.serve_forever()
+
+def asyncServerLoop(reusePort=False):
+    """Run the asyncio server until interrupted"""
+    try:
+        asyncio.run(asyncServe(reusePort))
+    except KeyboardInterrupt:
+        print("Terminating server...")
+        metadataStore.close()
+        sys.exit(0)
+# end of asyncio server
+#-----------------------------
+
+def parseArgs():
+    """Parse the command line options of the server"""
+    parser = argparse.ArgumentParser(description="TreeDrive file server")
+    parser.add_argument("--metadata-backend", choices=("json", "sqlite"), default=METADATA_BACKEND,
+                        help=f"where file metadata is kept (default: {METADATA_BACKEND})")
+    parser.add_argument("--storage", choices=("files", "blocks"), default=STORAGE_BACKEND,
+                        help=f"how uploaded files are kept: whole, or as deduplicated blocks (default: {STORAGE_BACKEND})")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve clients with asyncio coroutines instead of the selector loop")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="run N server processes sharing the port (needs the sqlite metadata backend)")
+    parser.add_argument("--migrate-metadata", action="store_true",
+                        help=f"import {METADATA_FILE} into {METADATA_DB} and exit")
+    return parser.parse_args()
+
+def runServer(args, reusePort=False):
+    """Open the metadata store and serve clients until interrupted"""
+    # Open the metadata store once, it is kept open from here on
+    global metadataStore, blockStore, storageBackend, lastChange
+    metadataStore = openMetadataStore(args.metadata_backend)
+    metadataStore.start()
+    if reusePort:   # One of several workers, file changes go through the change log they share
+        lastChange = metadataStore.lastChange()
+    storageBackend = args.storage
+    if storageBackend == "blocks" or os.path.isdir(BLOCK_PATH):    # Files kept in blocks before stay readable
+        blockStore = BlockStore()
+
+    if args.asyncio:
+        asyncServerLoop(reusePort)
+        return
+
+    # Setup the socket
+    serverSocket = setupSocket(reusePort)
+
+    # Listen to that socket for a while
+    serverLoop(serverSocket)
+
+def runWorkers(args):
+    """
+    Forks args.workers processes that each bind PORT with SO_REUSEPORT, so the kernel spreads new connections
+    across them, and each runs its own server loop. Every worker opens its own connection to the sqlite
+    metadata database, which is what keeps metadata consistent between them.
+    Waits until all workers have exited.
+    """
+    workers = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:    # Worker
+            os.setpgrp()    # Leave the terminal's process group, the parent decides when workers stop
+            try:
+                runServer(args, reusePort=True)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)     # Never fall back into the parent's code
+        workers.append(pid)
+    print(f"Started {len(workers)} workers: {' '.join(str(pid) for pid in workers)}\n")
+
+    def stopWorkers(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGINT)
+    signal.signal(signal.SIGTERM, stopWorkers)
+
+    while workers:
+        try:
+            pid, _ = os.wait()
+            workers.remove(pid)
+        except KeyboardInterrupt:
+            print("Stopping workers...")
+            stopWorkers(signal.SIGINT, None)
+        except ChildProcessError:
+            break
+
+def cleanStaging():
+    """Removes staged uploads that were never finished and have not been touched for STAGING_MAX_AGE seconds"""
+    cutoff = datetime.now().timestamp() - STAGING_MAX_AGE
+    for entry in os.scandir(STAGING_PATH):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+            print(f"Removed abandoned upload {entry.name}")
+
 def main():
     """
     Main Loop:
         Sets up the server socket.
         Listens repeatedley on that socket.
     """
-
-    # If the server file directory is missing, creates it
+    args = parseArgs()
+    if args.migrate_metadata:
+        migrateMetadata()
+        return
+
+    if args.workers > 1:
+        if args.metadata_backend != "sqlite":
+            print("Error: --workers needs a metadata store shared between processes, use --metadata-backend sqlite "
+                  "(run --migrate-metadata first to bring existing metadata along).")
+            sys.exit(1)
+        if not hasattr(os, "fork") or not hasattr(sock, "SO_REUSEPORT"):
+            print("Error: --workers needs fork() and SO_REUSEPORT, which this platform does not have.")
+            sys.exit(1)
+
+    # The server is going to start. If the server file directory is missing, creates it
     if not os.path.exists(SERVER_FILE_PATH):
         print(f"{SERVER_FILE_PATH} directory missing. Creating directory.")
         os.mkdir(SERVER_FILE_PATH)
+    os.makedirs(STAGING_PATH, exist_ok=True)
+    cleanStaging()
 
-    # Load metadata
-    loadMetadata()
-
-    # Setup the socket
-    serverSocket = setupSocket()
-
-    # Listen to that socket for a while
-    serverLoop(serverSocket)
+    raiseFileLimit()
+    if args.workers > 1:
+        runWorkers(args)
+    else:
+        runServer(args)
 
 #------------------
 main()
-#------------------
\ No newline at end of file
+#------------------
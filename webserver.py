@@ -11,9 +11,21 @@ webserver.py
 """
 
 import socket as sock
+import struct
 import sys
 import threading
+import select
+import time
+import queue
+import json
+import selectors
 import os
+import zlib
+import lzma
+import gzip
+import hashlib
+import bisect
+from contextlib import contextmanager
 
 #-------------------------------
 # Load the configured Host and Port for webserver socket to bind to
@@ -23,9 +35,60 @@ PORT = 8271
 # Load the configured Host and Port for server socket for webserver to connect to
 FILESERVER_HOST = '127.0.0.1'
 FILESERVER_PORT = 8270
+
+# Compression for file data between the webserver and the fileserver: None, "zlib" or "lzma" with a level (0-9).
+# Only worth it when the fileserver is across a slow link, on the same machine it just costs CPU
+FILESERVER_COMPRESSION = None
+FILESERVER_COMPRESSION_LEVEL = 6
+
+# Pool of logged in connections to the fileserver, reused across requests
+FILESERVER_POOL_SIZE = 32 # most connections open to the fileserver at once, in use or idle
+FILESERVER_POOL_IDLE_PER_USER = 4 # idle connections kept for each user
+FILESERVER_POOL_IDLE_TIMEOUT = 60 # seconds an idle connection is kept before it is closed
+FILESERVER_POOL_WAIT = 30 # seconds a request waits for a connection when all of them are busy
+FILESERVER_TIMEOUT = 60 # seconds
+
+# Cache of LIST replies, shared by every browser. Pushes and deletes through this webserver clear it at once,
+# the TTL bounds how long changes made elsewhere (another webserver, client.py) take to show
+LIST_CACHE_TTL = 2 # seconds a LIST reply is reused for
+LIST_CACHE_SIZE = 256 # most different LISTs (pages, filters) kept
+
+# User the webserver logs in to the fileserver as for its own requests (file change events, metrics)
+SERVICE_USERNAME = "webserver"
+
+# Live file changes (/api/events). The webserver subscribes to the fileserver's changes once and passes them on to
+# every browser listening, as Server-Sent Events
+EVENT_STREAMS_MAX = 1024 # browsers listening at once, more get a 503
+EVENTS_HEARTBEAT = 15 # seconds between keep-alive comments on a quiet stream, they also find browsers that left
+EVENTS_BACKLOG = 65536 # bytes of events a browser can fall behind by before it is dropped
+EVENTS_RETRY = 5 # seconds before subscribing again after the fileserver connection broke
+
+# Worker pool. Accepted connections wait in the accept queue for a free worker, once it is full they get a 503
+WORKER_THREADS = 64 # threads handling requests
+TRANSFER_WORKERS = 16 # most workers busy with uploads/downloads at once, the rest stay free for quick API calls
+ACCEPT_QUEUE_SIZE = 128 # accepted connections waiting for a worker
+RETRY_AFTER = 5 # seconds a browser is told to wait (Retry-After) when the webserver is saturated
+CLIENT_TIMEOUT = 30 # seconds a worker waits on a silent browser before giving up on it
+
+# Keep-alive. Between requests a browser connection waits without holding a worker
+KEEPALIVE_TIMEOUT = 15 # seconds an idle connection is kept open for its next request
+KEEPALIVE_MAX_REQUESTS = 100 # requests served on one connection before it is closed
 #-------------------------------
 
-CHUNK_SIZE = 8192
+DOWNLOAD_BUFFER_SIZE = 262144 # buffer a download is forwarded through, from the fileserver to the browser
+UPLOAD_BUFFER_SIZE = 262144 # buffer an upload is forwarded through, one DATA frame at a time
+MAX_REQUEST_BODY = 65536 # largest body read into memory, only uploads are bigger and those are streamed
+UNREAD_BODY_LIMIT = 1048576 # most bytes of a refused request body read and thrown away to keep the connection open
+DRAIN_TIMEOUT = 10 # seconds spent reading a larger refused body after the answer, before closing the connection
+# Upper bounds (seconds) of the buckets of the latency histograms on /api/metrics
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+# Files of the web client, by request path: (file, content type). Kept in memory, see StaticAssets
+STATIC_FILES = {
+    "/": ("index.html", "text/html"),
+    "/style.css": ("style.css", "text/css"),
+    "/script.js": ("script.js", "application/javascript"),
+}
 
 def build_http_response(status_code=200, status_text="OK", body="", content_type="text/plain", headers=None):
     """
@@ -45,8 +108,16 @@ def build_http_response(status_code=200, status_text="OK", body="", content_type
         bytes = body.encode()
     else:
         bytes = body # handles raw binary if body is not a string
-    length = len(bytes)
+    return build_http_headers(status_code, status_text, len(bytes), content_type, headers) + bytes
+
+def build_http_headers(status_code=200, status_text="OK", length=0, content_type="text/plain", headers=None):
+    """
+    Constructs the status line and headers of an HTTP response, for a body of length bytes that is sent separately.
+    Takes the same parameters as build_http_response, with the body's length in place of the body.
 
+    Returns:
+        bytes: The head of the response, up to and including the blank line.
+    """
     # Default Headers #
     default_headers = [
         ("Content-Length", length),
@@ -62,55 +133,520 @@ def build_http_response(status_code=200, status_text="OK", body="", content_type
     for key, val in default_headers:
         response += f"{key}: {val}\r\n"
     response += "\r\n"
-    return response.encode() + bytes
+    return response.encode()
 
 class HTTPResponses:
     BAD_REQUEST = build_http_response(400, "Bad Request", "Bad Request", "text/plain")
+    PAYLOAD_TOO_LARGE = build_http_response(413, "Payload Too Large", "Payload Too Large", "text/plain")
     UNAUTHORIZED = build_http_response(401, "Unauthorized", "Unauthorized", "text/plain")
     NOT_FOUND = build_http_response(404, "Not Found", "Not Found", "text/plain")
+    RANGE_NOT_SATISFIABLE = build_http_response(416, "Range Not Satisfiable", "Range Not Satisfiable", "text/plain")
     INTERNAL_SERVER_ERROR = build_http_response(500, "Internal Server Error", "Internal Server Error", "text/plain")
     NOT_IMPLEMENTED = build_http_response(501, "Not Implemented", "Not Implemented", "text/plain")
     BAD_GATEWAY = build_http_response(502, "Bad Gateway", "File server error", "text/plain")
+    SERVICE_UNAVAILABLE = build_http_response(503, "Service Unavailable", "Server busy, please try again", "text/plain",
+                                              headers=[("Retry-After", RETRY_AFTER), ("Connection", "close")])
+
+class StaticAsset:
+    """
+    One file of the web client, held in memory as ready to send responses: the file itself, a gzip copy of it, and
+    the 304 Not Modified for browsers that have it already. The ETag is a hash of the content, so it only changes
+    when the file does.
+    """
+    __slots__ = ("mtime", "etag", "response", "gzip_response", "not_modified")
+
+    def __init__(self, filename, content_type, mtime):
+        with open(filename, "rb") as f:
+            data = f.read()
+        self.mtime = mtime
+        self.etag = f'"{hashlib.sha256(data).hexdigest()[:32]}"'
+        headers = [("ETag", self.etag), ("Cache-Control", "no-cache"), ("Vary", "Accept-Encoding")]
+        self.response = build_http_response(200, "OK", data, content_type, headers)
+        self.gzip_response = build_http_response(200, "OK", gzip.compress(data, 9, mtime=0), content_type,
+                                                 headers + [("Content-Encoding", "gzip")])
+        self.not_modified = build_http_response(304, "Not Modified", headers=headers)
+
+class StaticAssets:
+    """
+    The web client's files (STATIC_FILES), loaded when the webserver starts. Every request checks the file's mtime,
+    and a file that changed is loaded again.
+    """
+    def __init__(self):
+        self.assets = {} # path -> StaticAsset
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''Loads all of the files, the ones that are missing are answered with 404 until they appear'''
+        for path in STATIC_FILES:
+            self.get(path)
+
+    def get(self, path):
+        '''Returns the up to date StaticAsset for a path, or None if its file does not exist'''
+        filename, content_type = STATIC_FILES[path]
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+        asset = self.assets.get(path)
+        if asset is None or asset.mtime != mtime:
+            with self.lock:
+                asset = self.assets.get(path)
+                if asset is None or asset.mtime != mtime:
+                    try:
+                        asset = StaticAsset(filename, content_type, mtime)
+                    except OSError:
+                        return None
+                    self.assets[path] = asset
+                    print(f"[INFO] Loaded {filename}")
+        return asset
+
+    def response(self, path, headers):
+        '''Returns the response for a GET of a static file, given the request's headers'''
+        asset = self.get(path)
+        if asset is None:
+            return HTTPResponses.NOT_FOUND
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match and (if_none_match.strip() == "*" or asset.etag in (tag.strip() for tag in if_none_match.split(","))):
+            return asset.not_modified
+        if accepts_gzip(headers.get("Accept-Encoding", "")):
+            return asset.gzip_response
+        return asset.response
+
+static_assets = StaticAssets()
+
+def accepts_gzip(accept_encoding):
+    '''Whether an Accept-Encoding header allows gzip, "gzip;q=0" refuses it'''
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            params = params.replace(" ", "").lower()
+            if not params.startswith("q="):
+                return True
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+# Binary protocol (v2) the webserver talks to the file server with, see server.py
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct("!BII") # opcode, request id, payload length
+FRAME_DATA_SIZE = 262144 # Size of the DATA frames an upload is cut into
+
+class Opcode:
+    LOGIN = 1
+    LIST = 2
+    PUSH = 3
+    GET = 4
+    DELETE = 5
+    DATA = 6
+    READY = 7
+    OK = 8
+    ERROR = 9
+    END = 10
+    SUBSCRIBE = 11
+    EVENT = 12
+    STATS = 13
+
+def send_frame(fileserver_socket, opcode, payload=b"", request_id=1):
+    '''Sends one frame to the fileserver. A str payload is sent as utf-8'''
+    if isinstance(payload, str):
+        payload = payload.encode()
+    fileserver_socket.sendall(FRAME_HEADER.pack(opcode, request_id, len(payload)) + payload)
+
+def recv_exactly(fileserver_socket, count):
+    '''Receives exactly count bytes from the fileserver'''
+    data = bytearray(count)
+    view = memoryview(data)
+    received = 0
+    while received < count:
+        got = fileserver_socket.recv_into(view[received:])
+        if got == 0:
+            raise ConnectionError("File server closed the connection")
+        received += got
+    return data
+
+def recv_frame(fileserver_socket):
+    '''Receives the next frame from the fileserver as (opcode, request_id, payload)'''
+    opcode, request_id, length = FRAME_HEADER.unpack(recv_exactly(fileserver_socket, FRAME_HEADER.size))
+    return opcode, request_id, recv_exactly(fileserver_socket, length)
+
+def compression_option():
+    '''The option line asking the fileserver to compress a PUSH/GET, or "" if FILESERVER_COMPRESSION is off'''
+    if not FILESERVER_COMPRESSION:
+        return ""
+    return f"\ncompress {FILESERVER_COMPRESSION} {FILESERVER_COMPRESSION_LEVEL}"
+
+def ready_options(payload):
+    '''Splits a READY payload into its first line and its option lines as {name: value} ("compress", "sha256")'''
+    first, *lines = payload.decode().split("\n")
+    options = {}
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 2:
+            options[tokens[0]] = tokens[1]
+    return first, options
 
 def login_fileserver(username, fileserver_socket):
-    '''Attempts to login a user to the fileserver'''
+    '''Switches the connection to the binary protocol and attempts to login a user to the fileserver'''
     _ = fileserver_socket.recv(1024) # Get arbitrary welcome message from server, can cast it away after
-    fileserver_socket.sendall(f"LOGIN {username}\n".encode())
-    response = fileserver_socket.recv(1024) # Get login message from server
+    fileserver_socket.sendall(f"PROTO {PROTOCOL_VERSION}\n".encode())
+    response = fileserver_socket.recv(1024).decode()
+    if response.strip() != f"PROTO {PROTOCOL_VERSION} OK":
+        raise ConnectionError(f"File server does not speak protocol {PROTOCOL_VERSION}: {response.strip()}")
+    send_frame(fileserver_socket, Opcode.LOGIN, username)
+    opcode, _, response = recv_frame(fileserver_socket) # Get login message from server
+    if opcode != Opcode.OK:
+        raise ConnectionError(f"File server login failed: {response.decode()}")
     return response
 
-def send_command(command, username, fileserver_socket):
-    '''Send a command to the fileserver as a user'''
-    login_fileserver(username, fileserver_socket) # Login as user
-    fileserver_socket.sendall((command + "\n").encode()) # File server expects new-line terminated commands
-    response = b''
-    # Await response
-    while True:
-        chunk = fileserver_socket.recv(1024)
-        if not chunk:
-            break
-        response += chunk
-        if chunk.endswith(b"\n"):
-            break
-    return response.decode()
-
-def talk_to_file_server(username: str, command: str):
-    '''Establish a connection between the webserver and file server. Webserver sends a command to the fileserver as a user and receives a response'''
+def is_healthy(fileserver_socket):
+    '''
+    Checks an idle pooled connection before it is reused. An idle connection has nothing to say, so if it is
+    readable the fileserver has closed it (or it is out of step) and it must not be used
+    '''
     try:
-        with sock.create_connection((FILESERVER_HOST, FILESERVER_PORT)) as fileserver_socket:
-            response = send_command(command, username, fileserver_socket)
-            return response
-    except Exception as e:
-        print(f"[ERROR] File server connection failed: {e}")
+        readable, _, _ = select.select([fileserver_socket], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+class FileServerPool:
+    """
+    Thread-safe pool of logged in connections to the fileserver, keyed by username since a connection stays
+    logged in as the user it was opened for. Saves each request the connect, welcome, PROTO and LOGIN round trips.
+
+    At most max_connections are open at once (in use or idle). A request that finds them all in use closes an
+    idle connection of another user, or waits for one to be returned. Idle connections are closed after
+    idle_timeout seconds and checked before they are reused, one the fileserver has closed is replaced.
+    """
+    def __init__(self, max_connections=FILESERVER_POOL_SIZE, idle_per_user=FILESERVER_POOL_IDLE_PER_USER,
+                 idle_timeout=FILESERVER_POOL_IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_per_user = idle_per_user
+        self.idle_timeout = idle_timeout
+        self.idle = {} # username -> [(socket, when it was returned)], most recently returned last
+        self.open = 0 # connections open, in use or idle
+        self.condition = threading.Condition()
+
+    def close(self, fileserver_socket):
+        '''Closes a connection and frees its place in the pool. Caller must hold the condition'''
+        fileserver_socket.close()
+        self.open -= 1
+        self.condition.notify()
+
+    def evict(self):
+        '''Closes the connections that have been idle for longer than idle_timeout. Caller must hold the condition'''
+        cutoff = time.monotonic() - self.idle_timeout
+        for username, idle in list(self.idle.items()):
+            while idle and idle[0][1] < cutoff:
+                self.close(idle.pop(0)[0])
+            if not idle:
+                del self.idle[username]
+
+    def evict_oldest(self):
+        '''Closes the connection that has been idle the longest, to make room. Returns False if none are idle'''
+        oldest = min(self.idle, key=lambda username: self.idle[username][0][1], default=None)
+        if oldest is None:
+            return False
+        self.close(self.idle[oldest].pop(0)[0])
+        if not self.idle[oldest]:
+            del self.idle[oldest]
+        return True
+
+    def acquire(self, username):
+        '''Takes a logged in connection for username out of the pool, opening a new one if none is idle'''
+        with self.condition:
+            while True:
+                self.evict()
+                idle = self.idle.get(username)
+                while idle:
+                    fileserver_socket, _ = idle.pop()
+                    if not idle:
+                        del self.idle[username]
+                    if is_healthy(fileserver_socket):
+                        return fileserver_socket
+                    self.close(fileserver_socket) # the fileserver went away, reconnect
+                if self.open < self.max_connections or self.evict_oldest():
+                    self.open += 1
+                    break
+                if not self.condition.wait(FILESERVER_POOL_WAIT):
+                    raise ConnectionError("No connection to the file server became free")
+        try:
+            fileserver_socket = sock.create_connection((FILESERVER_HOST, FILESERVER_PORT), FILESERVER_TIMEOUT)
+        except BaseException:
+            with self.condition:
+                self.open -= 1
+                self.condition.notify()
+            raise
+        try:
+            login_fileserver(username, fileserver_socket) # Login as user
+        except BaseException:
+            with self.condition:
+                self.close(fileserver_socket)
+            raise
+        return fileserver_socket
+
+    def release(self, username, fileserver_socket):
+        '''Returns a connection to the pool. One that was closed, or is over the idle limit, is dropped'''
+        with self.condition:
+            if fileserver_socket.fileno() == -1:
+                self.open -= 1
+                self.condition.notify()
+                return
+            idle = self.idle.setdefault(username, [])
+            if len(idle) < self.idle_per_user:
+                idle.append((fileserver_socket, time.monotonic()))
+                self.condition.notify()
+            else:
+                self.close(fileserver_socket)
+
+    @contextmanager
+    def connection(self, username):
+        '''
+        Borrows a connection for a with block. It goes back to the pool afterwards unless the block raised,
+        or closed the connection because it left it part way through a command
+        '''
+        fileserver_socket = self.acquire(username)
+        try:
+            yield fileserver_socket
+        except BaseException:
+            fileserver_socket.close()
+            raise
+        finally:
+            self.release(username, fileserver_socket)
+
+fileserver_pool = FileServerPool()
+
+def send_command(opcode, payload, fileserver_socket):
+    '''Send a command to the fileserver. Returns the opcode (OK or ERROR) and text of the reply'''
+    send_frame(fileserver_socket, opcode, payload)
+    reply_opcode, _, response = recv_frame(fileserver_socket)
+    return reply_opcode, response.decode()
+
+def talk_to_file_server(username: str, opcode: int, payload=""):
+    '''
+    Webserver sends a command to the fileserver as a user, over a pooled connection, and receives a response.
+    A LIST that fails is tried once more on a new connection, in case the fileserver dropped the pooled one
+    '''
+    attempts = 2 if opcode == Opcode.LIST else 1
+    for attempt in range(attempts):
+        try:
+            with fileserver_pool.connection(username) as fileserver_socket:
+                return send_command(opcode, payload, fileserver_socket)
+        except Exception as e:
+            print(f"[ERROR] File server connection failed: {e}")
+    return None
+
+
+LIST_OPTIONS = ("prefix", "owner", "sort", "limit", "cursor", "format")
+
+class ListCache:
+    """
+    LIST replies from the fileserver, by LIST payload, reused for LIST_CACHE_TTL seconds. The list is the same for
+    every user, so one reply serves them all.
+    Requests that miss while the same LIST is already on its way to the fileserver wait for that reply instead of
+    sending their own. invalidate() drops everything, and a reply to a LIST sent before it is handed to the requests
+    that waited for it but not kept.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replies = {} # payload -> (expiry time, reply)
+        self.pending = {} # payload -> PendingList being fetched
+        self.generation = 0 # bumped by invalidate()
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0 # misses that waited for another request's LIST
+
+    class PendingList:
+        '''A LIST on its way to the fileserver, requests that miss meanwhile wait for its reply'''
+        __slots__ = ("done", "reply")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.reply = None
+
+    def get(self, username, payload):
+        '''Returns the (opcode, text) reply to a LIST, from the cache or the fileserver. None if the fileserver failed'''
+        with self.lock:
+            cached = self.replies.get(payload)
+            if cached and cached[0] > time.monotonic():
+                self.hits += 1
+                return cached[1]
+            pending = self.pending.get(payload)
+            waiting = pending is not None
+            if waiting:
+                self.merged += 1
+            else:
+                self.misses += 1
+                pending = self.pending[payload] = self.PendingList()
+                generation = self.generation
+        if waiting:
+            pending.done.wait(FILESERVER_TIMEOUT)
+            return pending.reply
+
+        try:
+            pending.reply = talk_to_file_server(username, Opcode.LIST, payload)
+        finally:
+            with self.lock:
+                if self.pending.get(payload) is pending:
+                    del self.pending[payload]
+                if pending.reply is not None and generation == self.generation:
+                    if len(self.replies) >= LIST_CACHE_SIZE:
+                        self.replies.clear()
+                    self.replies[payload] = (time.monotonic() + LIST_CACHE_TTL, pending.reply)
+            pending.done.set()
+        return pending.reply
+
+    def invalidate(self):
+        '''Forgets every reply, after the files on the fileserver changed'''
+        with self.lock:
+            self.replies.clear()
+            self.pending.clear()
+            self.generation += 1
+
+    def snapshot(self):
+        '''Returns the counters as a dictionary'''
+        with self.lock:
+            return {"entries": len(self.replies), "hits": self.hits, "misses": self.misses, "merged": self.merged}
+
+list_cache = ListCache()
+
+class EventStreams:
+    """
+    The browsers listening on /api/events. A thread of its own holds one SUBSCRIBE on the fileserver and sends each
+    file change EVENT on to every browser as a Server-Sent Event (data: the event's JSON). Changes also clear the
+    LIST cache, so they show up in lists at once, wherever they were made.
+    After (re)subscribing, browsers get a "reset" event, since they may have missed changes in between.
+    """
+    HEADERS = (b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n"
+               + f"retry: {EVENTS_RETRY * 1000}\n\n".encode())
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {} # browser socket -> events it has not taken yet
+        self.selector = selectors.DefaultSelector() # the fileserver connection, and browsers that are behind
+
+    def add(self, conn):
+        '''Hands a browser connection over to the event thread. Returns None once it is listening, or a 503'''
+        with self.lock:
+            if len(self.streams) >= EVENT_STREAMS_MAX:
+                return HTTPResponses.SERVICE_UNAVAILABLE
+            conn.sendall(self.HEADERS)
+            conn.setblocking(False) # from here on only the event thread sends to it, without ever waiting on it
+            self.streams[conn] = bytearray()
         return None
 
+    def count(self):
+        '''Number of browsers listening'''
+        return len(self.streams)
+
+    def broadcast(self, message):
+        '''
+        Queues a message for every browser and sends what each one takes right away. A browser that is behind gets
+        the rest when its socket is writable again (flush), so it does not hold up the others
+        '''
+        data = message.encode()
+        with self.lock:
+            streams = list(self.streams.items())
+        for conn, backlog in streams:
+            backlog += data
+            self.flush(conn, backlog)
+
+    def flush(self, conn, backlog):
+        '''
+        Sends a browser as much of its backlog as its socket takes without blocking, and waits on the socket for
+        the rest. Drops the browser if it is gone, or more than EVENTS_BACKLOG behind
+        '''
+        try:
+            del backlog[:conn.send(backlog)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(conn)
+            return
+        if len(backlog) > EVENTS_BACKLOG:
+            print("[WARN] Dropping a browser that fell too far behind on file changes")
+            self.drop(conn)
+            return
+        waiting = conn in self.selector.get_map()
+        if backlog and not waiting:
+            self.selector.register(conn, selectors.EVENT_WRITE, backlog)
+        elif not backlog and waiting:
+            self.selector.unregister(conn)
 
-def handle_get_list(username):
-    """Handles calling get list from the file server. Returns the formatted http response"""
-    fs_response = talk_to_file_server(username, "LIST")
+    def drop(self, conn):
+        '''Stops sending changes to a browser and closes its connection'''
+        if conn in self.selector.get_map():
+            self.selector.unregister(conn)
+        with self.lock:
+            del self.streams[conn]
+        conn.close()
+
+    def subscribe(self):
+        '''Opens the connection to the fileserver the changes come in on'''
+        fileserver_socket = sock.create_connection((FILESERVER_HOST, FILESERVER_PORT), FILESERVER_TIMEOUT)
+        try:
+            login_fileserver(SERVICE_USERNAME, fileserver_socket)
+            opcode, text = send_command(Opcode.SUBSCRIBE, "", fileserver_socket)
+            if opcode != Opcode.OK:
+                raise ConnectionError(text)
+        except BaseException:
+            fileserver_socket.close()
+            raise
+        return fileserver_socket
+
+    def run(self):
+        '''The event thread'''
+        while True:
+            try:
+                fileserver_socket = self.subscribe()
+            except Exception as e:
+                print(f"[ERROR] Subscribing to file changes failed: {e}")
+                time.sleep(EVENTS_RETRY)
+                continue
+            self.selector.register(fileserver_socket, selectors.EVENT_READ)
+            try:
+                list_cache.invalidate()
+                self.broadcast("event: reset\ndata: {}\n\n")
+                heartbeat = time.monotonic() + EVENTS_HEARTBEAT
+                while True:
+                    for key, _ in self.selector.select(max(0, heartbeat - time.monotonic())):
+                        if key.fileobj is not fileserver_socket:
+                            if key.fileobj in self.streams: # not dropped by a broadcast since the select
+                                self.flush(key.fileobj, key.data) # a browser that was behind can take more
+                            continue
+                        opcode, _, payload = recv_frame(fileserver_socket)
+                        if opcode == Opcode.EVENT:
+                            list_cache.invalidate()
+                            self.broadcast(f"data: {payload.decode()}\n\n")
+                    if time.monotonic() >= heartbeat:
+                        self.broadcast(": keep-alive\n\n")
+                        heartbeat = time.monotonic() + EVENTS_HEARTBEAT
+            except Exception as e:
+                print(f"[ERROR] File change subscription broke: {e}")
+            finally:
+                self.selector.unregister(fileserver_socket)
+                fileserver_socket.close()
+
+event_streams = EventStreams()
+
+def handle_get_list(username, query=None):
+    """
+    Handles calling get list from the file server. Returns the formatted http response.
+    The query's LIST_OPTIONS are passed on as the LIST's option lines, so /api/list?format=json&limit=100 returns a
+    page of the list as JSON, straight from the file server
+    """
+    options = [f"{key} {val}" for key, val in (query or {}).items() if key in LIST_OPTIONS and val]
+    fs_response = list_cache.get(username, "\n".join(options))
     if fs_response is not None:
-        body = fs_response
-        response = build_http_response(200, "OK", body, "application/octet-stream")
+        opcode, body = fs_response
+        if opcode != Opcode.OK:
+            response = build_http_response(400, "Bad Request", body, "text/plain")
+        elif query and query.get("format") == "json":
+            response = build_http_response(200, "OK", body, "application/json")
+        else:
+            response = build_http_response(200, "OK", body, "application/octet-stream")
     else:
         response = HTTPResponses.BAD_GATEWAY
     return response
@@ -121,107 +657,254 @@ def handle_download_file(username, filename):
 
 def handle_delete(username, filename):
     """Handles calling delete <filename> from the file server. Returns the formatted http response"""
-    fs_response = talk_to_file_server(username, f"DELETE {filename}")
+    fs_response = talk_to_file_server(username, Opcode.DELETE, filename)
     if fs_response is not None:
-        if not fs_response.startswith("Permission"):
-            response = build_http_response(200, "OK", fs_response, "application/octet-stream")
-        else:
+        opcode, text = fs_response
+        if opcode == Opcode.OK:
+            response = build_http_response(200, "OK", text, "application/octet-stream")
+        elif text.startswith("Permission"):
             response = HTTPResponses.UNAUTHORIZED
+        else:
+            response = HTTPResponses.NOT_FOUND
     else:
         response = HTTPResponses.BAD_GATEWAY
     return response
 
-def handle_download(username, filename):
+def parse_range(range_header):
     """
-    Handles calling the get <filename> from the file server. Returns the formatted http response
-    Webserver sends command and awaits an okay from the server. 
-    Then server sends the file size, then sends the file as raw bytes.
-    """ 
-    try:
-        with sock.create_connection((FILESERVER_HOST, FILESERVER_PORT)) as fileserver_socket:
-            fileserver_socket.settimeout(60) #
-            login_fileserver(username, fileserver_socket) # Login as user
+    Parses a Range header of a single byte range, "bytes=<first>-[<last>]".
+    Returns the offset and length (None for the rest of the file) to ask the fileserver for, or None if the
+    header is missing or not a range we serve, in which case the whole file is sent.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None # suffix ranges (bytes=-500) and multiple ranges are answered with the whole file
+    offset = int(first)
+    if not last:
+        return offset, None
+    if int(last) < offset:
+        return None
+    return offset, int(last) - offset + 1
 
-            fileserver_socket.sendall(f"GET {filename}\n".encode()) # Send initial Command
+def decompress_pieces(decompressor, data):
+    '''Yields what a decompressor makes of data, DOWNLOAD_BUFFER_SIZE bytes at a time so memory stays flat'''
+    while True:
+        piece = decompressor.decompress(data, DOWNLOAD_BUFFER_SIZE)
+        if piece:
+            yield piece
+        if decompressor.eof:
+            return
+        if isinstance(decompressor, lzma.LZMADecompressor):
+            if decompressor.needs_input:
+                return
+            data = b""
+        else:
+            data = decompressor.unconsumed_tail
+            if not data and len(piece) < DOWNLOAD_BUFFER_SIZE:
+                return
 
-            server_resp = fileserver_socket.recv(1024).decode() # Expect READY back from server
-            if not server_resp.startswith("READY"):
-                return HTTPResponses.NOT_FOUND
-            tokens = server_resp.split() # Check for correct number of tokens
-            if len(tokens) != 3:
-                return HTTPResponses.INTERNAL_SERVER_ERROR
+def forward_payload(fileserver_socket, length, conn, buffer, decompressor=None):
+    '''
+    Forwards the payload of a DATA frame, length bytes, from the fileserver to the browser socket conn.
+    It is received into buffer (reused for the whole download) and sent from there, never held whole.
+    Returns the number of bytes of the file forwarded
+    '''
+    view = memoryview(buffer)
+    forwarded = 0
+    while length:
+        got = fileserver_socket.recv_into(view[:min(length, len(view))])
+        if got == 0:
+            raise ConnectionError("File server closed the connection")
+        length -= got
+        if decompressor is None:
+            conn.sendall(view[:got])
+            forwarded += got
+            continue
+        for piece in decompress_pieces(decompressor, view[:got]):
+            conn.sendall(piece)
+            forwarded += len(piece)
+    return forwarded
 
-            incoming_filename = tokens[1]
-            filesize = int(tokens[2])
+def handle_download(conn, username, filename, range_header=None, if_none_match=None):
+    """
+    Handles calling the get <filename> from the file server.
+    Webserver sends the GET and the server answers READY with the file size,
+    then sends the file as DATA frames followed by END.
+    The file is streamed: the headers go to the browser (conn) as soon as READY says how big the file is, then each
+    DATA frame is forwarded as it arrives, so memory use does not grow with the size of the file.
+    Returns the formatted http response if there was an error, or None once the file has been sent.
+    A Range header turns into a ranged GET and a 206 Partial Content response.
+    The file's SHA-256 from READY is its ETag, a browser that already has that version gets 304 Not Modified.
+    """ 
+    byte_range = parse_range(range_header)
+    headers_sent = False
+    try:
+        with fileserver_pool.connection(username) as fileserver_socket:
+            # Send initial Command
+            command = filename
+            if byte_range is not None:
+                offset, length = byte_range
+                command += f"\nrange {offset}" + (f" {length}" if length else "")
+            send_frame(fileserver_socket, Opcode.GET, command + compression_option())
 
-            fileserver_socket.sendall("OK\n".encode()) # ping server OK
-            server_resp = fileserver_socket.recv(1024).decode() # last shake from server
-            fileserver_socket.sendall("OK\n".encode()) # ping server OK
+            opcode, _, payload = recv_frame(fileserver_socket) # Expect READY back from server
+            if opcode != Opcode.READY:
+                if payload.startswith(b"Error: Offset"):
+                    return HTTPResponses.RANGE_NOT_SATISFIABLE
+                return HTTPResponses.NOT_FOUND
+            ready, options = ready_options(payload)
+            method = options.get("compress")
+            etag = f'"{options["sha256"]}"' if "sha256" in options else None
+            if etag and if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+                fileserver_socket.close() # the file is on its way, the connection cannot be reused
+                return build_http_response(304, "Not Modified", headers=[("ETag", etag)])
+            if byte_range is None:
+                filesize = int(ready)
+            else:
+                filesize, offset, total = (int(token) for token in ready.split())
+            decompressor = None
+            if method is not None:
+                decompressor = lzma.LZMADecompressor() if method == "lzma" else zlib.decompressobj()
 
-            # Receive in the file
-            file_data = bytearray()
-            received = 0
-            while received < filesize:
-                packet = fileserver_socket.recv(min(1024, filesize - received))
-                if not packet:
-                    break
-                file_data.extend(packet)
-                received += len(packet)
-                fileserver_socket.sendall("CONTINUE\n".encode()) # ping server to continue download
+            if byte_range is not None and filesize == 0: # the range starts at the end of the file
+                recv_frame(fileserver_socket) # END
+                return build_http_response(416, "Range Not Satisfiable", "Range Not Satisfiable", "text/plain",
+                                           headers=[("Content-Range", f"bytes */{total}")])
 
-            fileserver_socket.sendall("DONE\n".encode("utf-8")) # ping server so it knows we are DONE
-           
             # Add new headers to our response
             headers = [
                  # this header isn't necessary for the implementation, but I liked having access 
                  #  to the filename while testing with Insomnia
-                ("Content-Disposition", f'attachment; filename="{incoming_filename}"'),
+                ("Content-Disposition", f'attachment; filename="{filename}"'),
+                ("Accept-Ranges", "bytes"),
             ]
+            if etag:
+                headers.append(("ETag", etag))
+            if byte_range is None:
+                conn.sendall(build_http_headers(200, "OK", filesize, headers=headers))
+            else:
+                headers.append(("Content-Range", f"bytes {offset}-{offset + filesize - 1}/{total}"))
+                conn.sendall(build_http_headers(206, "Partial Content", filesize, headers=headers))
+            headers_sent = True
 
-            response = build_http_response(200, "OK", body=file_data, headers=headers)
-            return response
+            # Forward the file
+            buffer = bytearray(DOWNLOAD_BUFFER_SIZE)
+            forwarded = 0
+            while True:
+                opcode, _, length = FRAME_HEADER.unpack(recv_exactly(fileserver_socket, FRAME_HEADER.size))
+                if opcode != Opcode.DATA:
+                    recv_exactly(fileserver_socket, length) # END, the whole file has been sent
+                    break
+                forwarded += forward_payload(fileserver_socket, length, conn, buffer, decompressor)
+            if opcode != Opcode.END or forwarded != filesize:
+                # Too late for an error status, closing the connection short of Content-Length tells the browser
+                raise ConnectionError(f"File server sent {forwarded} of the {filesize} bytes of {filename}")
+            return None
     
     except Exception as e:
         print(f"[ERROR] File server download failed: {e}")
+        if headers_sent:
+            raise # the browser has part of a response already, handle_client closes the connection
         return HTTPResponses.INTERNAL_SERVER_ERROR
 
-def handle_upload(username, filename, filesize, body):
+class IncompleteRequest(Exception):
+    """The browser closed the connection before it sent the whole request body"""
+
+def body_chunks(conn, initial, content_length, buffer):
+    """
+    Yields the body of a request in pieces of up to len(buffer) bytes, starting with initial (the part of it that
+    arrived with the headers). Each piece is received into buffer with recv_into and is a view of it, so it is
+    only valid until the next piece is asked for.
+    Raises IncompleteRequest if the browser goes away before content_length bytes have arrived.
+    """
+    view = memoryview(buffer)
+    initial = initial[:content_length]
+    view[:len(initial)] = initial # never more than one recv of the headers, it fits
+    filled = len(initial)
+    remaining = content_length - filled
+    while True:
+        while filled < len(view) and remaining:
+            got = conn.recv_into(view[filled:filled + min(remaining, len(view) - filled)])
+            if got == 0:
+                raise IncompleteRequest(f"Browser sent {content_length - remaining} of {content_length} body bytes")
+            filled += got
+            remaining -= got
+        if filled:
+            yield view[:filled]
+        if not remaining:
+            return
+        filled = 0
+
+def handle_upload(conn, username, filename, filesize, initial, checksum=None):
     """
     Webserver attempts to push a file filename over clientSocket. 
-    Webserver sends command and awaits an okay from the server. 
-    Then Webserver sends the file size, then sends the file as raw bytes.
+    Webserver sends the PUSH with the file size and awaits READY from the server.
+    Then Webserver sends the file as DATA frames.
+    The PUSH goes out as soon as the headers are in, and the body is piped from the browser (conn) to the
+    fileserver one UPLOAD_BUFFER_SIZE frame at a time, so the file is never held in memory. initial is the part of
+    the body that arrived with the headers.
+    If the browser sends the body's SHA-256 (checksum, from X-Content-SHA256) the PUSH carries it, and if the
+    fileserver has that exact file already nothing more is sent. Only then can the fileserver resume from what an
+    earlier push of the same content left staged, and it checks the whole file against the checksum at the end.
+    Without one the fileserver starts the file from scratch.
     """
+    chunks = body_chunks(conn, initial, filesize, bytearray(UPLOAD_BUFFER_SIZE))
     try:
-        with sock.create_connection((FILESERVER_HOST, FILESERVER_PORT)) as fileserver_socket:
-            fileserver_socket.settimeout(60) # seconds
-            login_fileserver(username, fileserver_socket) # Login as user
+        with fileserver_pool.connection(username) as fileserver_socket:
+            command = f"{filesize} {filename}"
+            if checksum:
+                command += f"\nsha256 {checksum}"
+            send_frame(fileserver_socket, Opcode.PUSH, command + compression_option()) # Send the initial command
 
-            fileserver_socket.sendall(f"PUSH {filename}\n".encode()) # Send the initial command
-
-            server_resp = fileserver_socket.recv(1024).decode("utf-8") # Expect READY from the server
-            if server_resp.startswith("Permission"):
-                return HTTPResponses.UNAUTHORIZED
-            if not server_resp.startswith("READY"):
+            opcode, _, payload = recv_frame(fileserver_socket) # Expect READY from the server
+            if opcode != Opcode.READY:
+                for _ in chunks: # read the body anyway, so the browser gets to see our answer
+                    pass
+                if opcode == Opcode.OK: # already up to date
+                    return build_http_response(200, "OK", body=payload.decode())
+                if payload.startswith(b"Permission"):
+                    return HTTPResponses.UNAUTHORIZED
                 return HTTPResponses.INTERNAL_SERVER_ERROR
             print(f"Pushing file: {filename}\n")
-
-            fileserver_socket.sendall(f"{filesize}\n".encode()) # send filesize to server
-
-            server_resp = fileserver_socket.recv(1024).decode("utf-8") # Expect OK from the server
-            if not server_resp.startswith("OK"):
-                return HTTPResponses.INTERNAL_SERVER_ERROR
             
-            # Send the file
-            sent_bytes = 0
-            while sent_bytes < filesize:
-                end = min(sent_bytes + CHUNK_SIZE, filesize)
-                fileserver_socket.sendall(body[sent_bytes:end])
-                sent_bytes = end
-
-            server_resp = fileserver_socket.recv(1024).decode() # final shake
+            # Send the file, from where an earlier push of it broke off if the server has part of it staged
+            ready, options = ready_options(payload)
+            method = options.get("compress")
+            skip = int(ready or 0)
+            if skip and not checksum:
+                # Nothing would tell the staged part apart from other content of the same size
+                raise ValueError(f"fileserver asked to resume {filename} at {skip} without a checksum")
+            compressor = None
+            if method is not None and skip < filesize:
+                compressor = lzma.LZMACompressor(preset=FILESERVER_COMPRESSION_LEVEL) if method == "lzma" else zlib.compressobj(FILESERVER_COMPRESSION_LEVEL)
+            for chunk in chunks:
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                chunk, skip = chunk[skip:], 0
+                if compressor is not None:
+                    data = compressor.compress(chunk)
+                    if data:
+                        send_frame(fileserver_socket, Opcode.DATA, data)
+                else:
+                    fileserver_socket.sendall(FRAME_HEADER.pack(Opcode.DATA, 1, len(chunk)))
+                    fileserver_socket.sendall(chunk)
+            if compressor is not None:
+                send_frame(fileserver_socket, Opcode.DATA, compressor.flush())
+
+            opcode, _, payload = recv_frame(fileserver_socket) # final shake
+            server_resp = payload.decode()
             print(f"Server Response: {server_resp}")
+            if opcode != Opcode.OK:
+                return HTTPResponses.INTERNAL_SERVER_ERROR
             return build_http_response(200, "OK", body=server_resp)
 
+    except IncompleteRequest as e:
+        # The fileserver keeps what it got staged, pushing the file again with its checksum carries on from there
+        print(f"[WARN] Upload of {filename} broke off: {e}")
+        return HTTPResponses.BAD_REQUEST
     except Exception as e:
         print(f"[ERROR] File server upload failed: {e}")
         return HTTPResponses.INTERNAL_SERVER_ERROR
@@ -313,86 +996,393 @@ def parse_cookies(headers):
                 cookies[key] = val
     return cookies
 
-def receive_http_request(conn):
+def receive_http_request(client):
     """
-    Receives in an entire HTTP request, including any headers and body that it may contain
+    Receives the headers of the next HTTP request on a BrowserConnection. The body is left to receive_http_body,
+    or streamed by handle_upload.
+    Bytes that arrived past the end of this request belong to the next one (pipelining), they are kept in
+    client.buffer. Sets client.keep_alive to whether the browser wants the connection kept open afterwards.
     
     Returns:
         method (str): the request method
         path_in (str): the request path
         headers (dict): dictionary of the headers in the request
         content_length (int): the Content-Length of the request
-        body (bytearray): the bytes of the body
+        body (bytes): the part of the body that arrived along with the headers
     """
-    buffer = b""
+    buffer = client.buffer
 
     # Load up to the end of headers
     while b"\r\n\r\n" not in buffer:
-        data = conn.recv(1024)
+        data = client.sock.recv(1024)
         if not data:
             break
         buffer += data
 
     header_end = buffer.find(b"\r\n\r\n") # find the end of the header, because our buffer MAY contain body after it already
+    if header_end == -1: # the browser closed the connection
+        client.buffer = b""
+        return None, None, {}, 0, b""
     header_bytes = buffer[:header_end]
     body_start = header_end + 4
-    body = buffer[body_start:] # we now MAY have part of the body in the buffer 
 
     header_lines = header_bytes.decode().splitlines()
     method, path_in, headers = parse_http_request(header_lines)
 
-    # If there is a body, we need to get content length, then read the rest of the body
     content_length = int(headers.get("Content-Length", 0))
-    while len(body) < content_length:
-        chunk = conn.recv(min(CHUNK_SIZE, content_length - len(body)))
-        if not chunk:
-            break  # connection closed prematurely
-        body += chunk
+    body = buffer[body_start:body_start + content_length] # we now MAY have part of the body in the buffer 
+    client.buffer = buffer[body_start + content_length:] # and MAYBE the start of the next request
 
+    # HTTP/1.1 keeps the connection open unless asked not to, HTTP/1.0 only if asked to
+    connection = headers.get("Connection", "").lower()
+    if header_lines[0].endswith("HTTP/1.0"):
+        client.keep_alive = connection == "keep-alive"
+    else:
+        client.keep_alive = connection != "close"
     return method, path_in, headers, content_length, body
 
-def handle_client(conn, addr):
+def discard_body(conn, remaining):
+    """
+    Reads and throws away the remaining bytes of a request body the webserver is not going to use, such as an
+    upload it refused. Closing a socket with unread data makes the kernel send a reset, which loses the answer.
+    Returns True if all of it was read, False if it is more than UNREAD_BODY_LIMIT or the browser went away.
+    """
+    if remaining > UNREAD_BODY_LIMIT:
+        return False
+    buffer = bytearray(min(remaining, UPLOAD_BUFFER_SIZE))
+    while remaining:
+        got = conn.recv_into(buffer, min(remaining, len(buffer)))
+        if got == 0:
+            return False
+        remaining -= got
+    return True
+
+def close_unread(conn, response):
+    """
+    Sends the last response on a connection whose request body was not read, then half-closes the connection and
+    reads until the browser closes its side, or DRAIN_TIMEOUT has passed, so the response arrives before the close
+    """
+    if b"\r\nConnection: close\r\n" not in response[:response.find(b"\r\n\r\n") + 2]:
+        response = add_header(response, "Connection", "close")
+    conn.sendall(response)
+    conn.shutdown(sock.SHUT_WR)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    buffer = bytearray(UPLOAD_BUFFER_SIZE)
+    try:
+        while (left := deadline - time.monotonic()) > 0:
+            conn.settimeout(left)
+            if conn.recv_into(buffer) == 0:
+                break
+    except OSError: # timed out or reset, either way we are done with it
+        pass
+
+def receive_http_body(conn, initial, content_length):
+    """
+    Receives the rest of a request body (initial is the part that arrived with the headers) into a single buffer.
+    Only for small bodies, see MAX_REQUEST_BODY.
+
+    Returns:
+        body (bytearray): the bytes of the body, short if the connection closed prematurely
+    """
+    body = bytearray(content_length)
+    view = memoryview(body)
+    initial = initial[:content_length]
+    view[:len(initial)] = initial
+    received = len(initial)
+    while received < content_length:
+        got = conn.recv_into(view[received:])
+        if got == 0:
+            break  # connection closed prematurely
+        received += got
+    del view
+    del body[received:]
+    return body
+
+class WorkerStats:
+    """
+    Counters of the worker pool, served as JSON on /api/stats to help size WORKER_THREADS, TRANSFER_WORKERS and
+    ACCEPT_QUEUE_SIZE. The peaks are the highest values seen since the webserver started.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = 0 # workers handling a request
+        self.busy_peak = 0
+        self.transfers = 0 # workers running an upload or download
+        self.transfers_peak = 0
+        self.queue_peak = 0
+        self.handled = 0
+        self.rejected_queue_full = 0 # connections answered 503 because the accept queue was full
+        self.rejected_transfers = 0 # uploads/downloads answered 503 because TRANSFER_WORKERS were busy
+
+    def count(self, **changes):
+        '''Adds to the named counters, keeping the peaks up to date'''
+        with self.lock:
+            for name, change in changes.items():
+                setattr(self, name, getattr(self, name) + change)
+            self.busy_peak = max(self.busy_peak, self.busy)
+            self.transfers_peak = max(self.transfers_peak, self.transfers)
+            self.queue_peak = max(self.queue_peak, accept_queue.qsize())
+
+    def snapshot(self):
+        '''Returns the counters and limits as a dictionary'''
+        with self.lock:
+            return {
+                "workers": WORKER_THREADS,
+                "workers_busy": self.busy,
+                "workers_busy_peak": self.busy_peak,
+                "transfer_workers": TRANSFER_WORKERS,
+                "transfers": self.transfers,
+                "transfers_peak": self.transfers_peak,
+                "queue_size": ACCEPT_QUEUE_SIZE,
+                "queue_depth": accept_queue.qsize(),
+                "queue_peak": self.queue_peak,
+                "idle_connections": idle_connections.count(),
+                "requests_handled": self.handled,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_transfers": self.rejected_transfers,
+            }
+
+accept_queue = queue.Queue(ACCEPT_QUEUE_SIZE) # BrowserConnections waiting for a worker
+transfer_slots = threading.BoundedSemaphore(TRANSFER_WORKERS)
+worker_stats = WorkerStats()
+
+# Routes requests are counted under on /api/metrics, any other path counts as "other"
+ROUTES = (*STATIC_FILES, "/api/login", "/api/list", "/api/get", "/api/push", "/api/delete", "/api/events",
+          "/api/stats", "/api/metrics")
+
+class Histogram:
+    """Counts of observed values (seconds) by LATENCY_BUCKETS, with their sum"""
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1) # the last one is everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    The webserver's counters and histograms, by name and labels, reported on /api/metrics in the Prometheus text
+    format along with the fileserver's own (its STATS command). Gauges are read when a report is made.
+    """
+    HELP = {
+        "requests_total": ("counter", "HTTP requests answered, by route and status"),
+        "request_seconds": ("histogram", "Time to answer an HTTP request, by route. Uploads and downloads included"),
+        "request_errors_total": ("counter", "HTTP requests that failed part way, or could not be parsed"),
+        "requests_handled_total": ("counter", "Connections handled by the workers"),
+        "rejected_queue_full_total": ("counter", "Connections answered 503 because the accept queue was full"),
+        "rejected_transfers_total": ("counter", "Uploads/downloads answered 503 because every transfer worker was busy"),
+        "list_cache_hits_total": ("counter", "LISTs answered from the LIST cache"),
+        "list_cache_misses_total": ("counter", "LISTs sent to the fileserver"),
+        "list_cache_merged_total": ("counter", "LISTs that waited for the same LIST already sent to the fileserver"),
+        "workers_busy": ("gauge", "Workers handling a request"),
+        "transfers": ("gauge", "Workers running an upload or download"),
+        "queue_depth": ("gauge", "Accepted connections waiting for a worker"),
+        "idle_connections": ("gauge", "Keep-alive connections waiting for their next request"),
+        "event_streams": ("gauge", "Browsers listening for file changes"),
+        "fileserver_connections": ("gauge", "Connections open to the fileserver, in use or idle"),
+        "fileserver_up": ("gauge", "Whether the fileserver answered STATS for this report"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels) -> value, labels are a tuple of (label, value) pairs
+        self.histograms = {} # (name, labels) -> Histogram
+
+    def count(self, name, value=1, **labels):
+        '''Adds value to a counter'''
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        '''Records a time in a histogram'''
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def report(self, gauges):
+        '''Returns the metrics, plus gauges ({name: value}), in the Prometheus text format'''
+        with self.lock:
+            series = {**self.counters, **{(name, ()): value for name, value in gauges.items()}}
+            histograms = {key: (list(h.buckets), h.sum, h.count) for key, h in self.histograms.items()}
+        lines = []
+        for name, (kind, description) in self.HELP.items():
+            lines.append(f"# HELP treedrive_webserver_{name} {description}")
+            lines.append(f"# TYPE treedrive_webserver_{name} {kind}")
+            for (series_name, labels), value in sorted(series.items()):
+                if series_name == name:
+                    lines.append(f"treedrive_webserver_{name}{format_labels(labels)} {value}")
+            for (series_name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip((*LATENCY_BUCKETS, "+Inf"), buckets):
+                    cumulative += bucket
+                    lines.append(f"treedrive_webserver_{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"treedrive_webserver_{name}_sum{format_labels(labels)} {total:.6f}")
+                lines.append(f"treedrive_webserver_{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines)
+
+def format_labels(labels):
+    '''Formats (label, value) pairs as a Prometheus label set, {a="1",b="2"}'''
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+metrics = Metrics()
+
+def record_request(path, response, started):
+    '''Records an answered request. A response of None was streamed by its handler and went out as a 200'''
+    route = path if path in ROUTES else "other"
+    status = int(response[9:12]) if response else 200
+    metrics.count("requests_total", route=route, status=status)
+    metrics.observe("request_seconds", time.perf_counter() - started, route=route)
+
+def handle_metrics():
+    '''Returns the webserver's metrics and the fileserver's (STATS), in the Prometheus text format'''
+    fs_response = talk_to_file_server(SERVICE_USERNAME, Opcode.STATS)
+    fileserver_up = fs_response is not None and fs_response[0] == Opcode.OK
+    stats = worker_stats.snapshot()
+    cache = list_cache.snapshot()
+    gauges = {
+        "requests_handled_total": stats["requests_handled"],
+        "rejected_queue_full_total": stats["rejected_queue_full"],
+        "rejected_transfers_total": stats["rejected_transfers"],
+        "list_cache_hits_total": cache["hits"],
+        "list_cache_misses_total": cache["misses"],
+        "list_cache_merged_total": cache["merged"],
+        "workers_busy": stats["workers_busy"],
+        "transfers": stats["transfers"],
+        "queue_depth": stats["queue_depth"],
+        "idle_connections": stats["idle_connections"],
+        "event_streams": event_streams.count(),
+        "fileserver_connections": fileserver_pool.open,
+        "fileserver_up": int(fileserver_up),
+    }
+    body = metrics.report(gauges) + "\n"
+    if fileserver_up:
+        body += fs_response[1] + "\n"
+    return build_http_response(200, "OK", body, "text/plain; version=0.0.4")
+
+def add_header(response, key, val):
+    '''Returns a copy of a built response with one more header, added right after the status line'''
+    status_end = response.index(b"\r\n")
+    return response[:status_end] + f"\r\n{key}: {val}".encode() + response[status_end:]
+
+class BrowserConnection:
+    """A browser's connection to the webserver, kept open across requests (keep-alive)"""
+    __slots__ = ("sock", "addr", "buffer", "requests", "keep_alive", "idle_since")
+
+    def __init__(self, conn, addr):
+        self.sock = conn
+        self.addr = addr
+        self.buffer = b"" # received bytes of requests not handled yet
+        self.requests = 0 # requests served so far
+        self.keep_alive = False
+        self.idle_since = 0.0
+
+class IdleConnections:
     """
-    handle_client() attempts to receive an HTTP Request from socket conn and parses the request.
+    Keep-alive connections in between requests. A thread of their own waits on them all with a selector, queues a
+    connection for a worker once its next request arrives, and closes those idle for longer than KEEPALIVE_TIMEOUT.
+    Workers hand connections over through a queue, and wake the thread up with a byte on a socket pair.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.parked = queue.SimpleQueue()
+        self.wakeup_receiver, self.wakeup_sender = sock.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+
+    def park(self, client):
+        '''Hands an idle connection over to the idle thread'''
+        client.idle_since = time.monotonic()
+        self.parked.put(client)
+        self.wakeup_sender.send(b"\0")
+
+    def count(self):
+        '''Number of idle connections being waited on'''
+        return len(self.selector.get_map()) - 1
+
+    def run(self):
+        '''The idle thread'''
+        while True:
+            for key, _ in self.selector.select(1):
+                if key.fileobj is self.wakeup_receiver:
+                    try:
+                        self.wakeup_receiver.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                queue_connection(key.data) # next request is here
+            while not self.parked.empty():
+                client = self.parked.get()
+                self.selector.register(client.sock, selectors.EVENT_READ, client)
+            cutoff = time.monotonic() - KEEPALIVE_TIMEOUT
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None and key.data.idle_since < cutoff:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+idle_connections = IdleConnections()
+
+def run_transfer(handler, *args):
+    """
+    Runs an upload/download handler if fewer than TRANSFER_WORKERS are running, so long transfers cannot take every
+    worker away from quick API calls. Otherwise answers 503 right away, without touching the fileserver
+    """
+    if not transfer_slots.acquire(blocking=False):
+        worker_stats.count(rejected_transfers=1)
+        return HTTPResponses.SERVICE_UNAVAILABLE
+    worker_stats.count(transfers=1)
+    try:
+        return handler(*args)
+    finally:
+        worker_stats.count(transfers=-1)
+        transfer_slots.release()
+
+def handle_request(client):
+    """
+    handle_request() attempts to receive an HTTP Request from a BrowserConnection and parses the request.
     If a valid request exists it processes the request and passes off to helper functions accordingly.
 
-    Send a valid HTTP Response back to socket conn
-    
+    Send a valid HTTP Response back to the browser. Returns True if the connection can carry on with another request,
+    None if it was handed over to event_streams
     """
+    conn, addr = client.sock, client.addr
     try:
 
-        method, path_in, headers, content_length, body = receive_http_request(conn)
+        method, path_in, headers, content_length, body = receive_http_request(client)
         if not method or not path_in: # skip if request is malformed
-            return
+            return False
+        client.requests += 1
+        started = time.perf_counter()
         print(f"[INFO] Request from {addr}:\n{method} {path_in}")      
         path, query = parse_pathquery(path_in) # Split path and query
+        unread = 0 # body bytes of a refused request still to be read before the answer can go out
+        if not (path == "/api/push" and method == "POST"): # uploads are streamed, everything else is small
+            if content_length > MAX_REQUEST_BODY:
+                if not discard_body(conn, content_length - len(body)):
+                    close_unread(conn, HTTPResponses.PAYLOAD_TOO_LARGE)
+                    return False
+                conn.sendall(add_header(HTTPResponses.PAYLOAD_TOO_LARGE, "Connection", "close"))
+                return False
+            body = receive_http_body(conn, body, content_length)
         cookies = parse_cookies(headers)
         username = cookies.get("username") # Get username (if logged in)
 
-        if path == "/" and method == "GET":
-            # Load html for webpage
-            if os.path.exists("index.html"):
-                with open("index.html", "r") as f:
-                    response = build_http_response(200, "OK", body=f.read(), content_type="text/html")
-                    f.close()
-            else:
-                response = HTTPResponses.NOT_FOUND
-        elif path == "/style.css" and method == "GET":
-            # Load stylesheet for webpage
-            if os.path.exists("style.css"):
-                with open("style.css", "r") as f:
-                    response = build_http_response(200, "OK", body=f.read(), content_type="text/css")
-                    f.close()
-            else:
-                response = HTTPResponses.NOT_FOUND
-        elif path == "/script.js" and method == "GET":
-            # Load Javascript file for webpage
-            if os.path.exists("script.js"):
-                with open("script.js", "r") as f:
-                    response = build_http_response(200, "OK", body=f.read(), content_type="application/javascript")
-                    f.close()
-            else:
-                response = HTTPResponses.NOT_FOUND
+        if path in STATIC_FILES and method == "GET":
+            # Webpage html, stylesheet and Javascript, from memory
+            response = static_assets.response(path, headers)
         elif path == "/api/login":
             # User attempting login
             if method == "POST":
@@ -411,46 +1401,139 @@ def handle_client(conn, addr):
         elif path == "/api/list" and method == "GET":
             if username:
                 # list command from server
-                response = handle_get_list(username)
+                response = handle_get_list(username, query)
             else:
                 response = HTTPResponses.UNAUTHORIZED
         elif path == "/api/get" and method == "GET":
             if username:
                 # download a file from the server
                 filename = query.get("file")
-                response = handle_download(username, filename)
+                response = run_transfer(handle_download, conn, username, filename, headers.get("Range"), headers.get("If-None-Match"))
             else:
                 response = HTTPResponses.UNAUTHORIZED
         elif path == "/api/push" and method == "POST":
             if username:
                 # upload a new file on the server
                 filename = query.get("file")
-                response = handle_upload(username, filename, content_length, body)
+                response = run_transfer(handle_upload, conn, username, filename, content_length, body, headers.get("X-Content-SHA256"))
+                if response is HTTPResponses.SERVICE_UNAVAILABLE: # no transfer slot, handle_upload never ran
+                    unread = content_length - len(body)
+                list_cache.invalidate()
             else:
                 response = HTTPResponses.UNAUTHORIZED
+                unread = content_length - len(body)
         elif path == "/api/delete" and method == "DELETE":
             if username:
                 # delete a file from the server
                 filename = query.get("file")
                 response = handle_delete(username, filename)
+                list_cache.invalidate()
+            else:
+                response = HTTPResponses.UNAUTHORIZED
+        elif path == "/api/events" and method == "GET":
+            if username:
+                # live file changes, the connection stays with event_streams from here on
+                response = event_streams.add(conn)
+                if response is None:
+                    record_request(path, None, started)
+                    return None
             else:
                 response = HTTPResponses.UNAUTHORIZED
+        elif path == "/api/metrics" and method == "GET":
+            # Prometheus metrics of the webserver and the fileserver
+            response = handle_metrics()
+        elif path == "/api/stats" and method == "GET":
+            # worker pool and LIST cache use, for sizing them
+            stats = dict(worker_stats.snapshot(), list_cache=list_cache.snapshot(), event_streams=event_streams.count())
+            response = build_http_response(200, "OK", json.dumps(stats), "application/json")
         else:
             response = HTTPResponses.NOT_FOUND
 
-        # Send back HTTP Response to client
-        conn.sendall(response)   
+        # A refused upload's body is read before answering, or the answer would be lost to a reset
+        if unread and not discard_body(conn, unread):
+            close_unread(conn, response)
+            record_request(path, response, started)
+            return False
+
+        # An upload that did not succeed may have left part of its body unread, the connection cannot be reused
+        keep_alive = client.keep_alive and client.requests < KEEPALIVE_MAX_REQUESTS
+        if path == "/api/push" and response is not None and not response.startswith(b"HTTP/1.1 200"):
+            keep_alive = False
+
+        # Send back HTTP Response to client, unless the handler streamed it already
+        if response is not None:
+            if b"\r\nConnection: close\r\n" in response[:response.find(b"\r\n\r\n") + 2]: # e.g. 503
+                keep_alive = False
+            elif not keep_alive:
+                response = add_header(response, "Connection", "close")
+            conn.sendall(response)
+        record_request(path, response, started)
+        return keep_alive
 
     except ValueError as e:
         print(f"[WARN] Malformed request from {addr}: {e}")
-        conn.sendall(HTTPResponses.BAD_REQUEST)
+        metrics.count("request_errors_total")
+        conn.sendall(add_header(HTTPResponses.BAD_REQUEST, "Connection", "close"))
     except Exception as e:
         print(f"Error: handle_client error: {e}")
+        metrics.count("request_errors_total")
+    return False
+
+def handle_client(client):
+    """
+    Serves requests on a BrowserConnection for as long as it is kept alive. Requests the browser sent already
+    (pipelined) are answered one after another, then the idle connection is parked with idle_connections until
+    its next request arrives, so it does not hold the worker in the meantime.
+    """
+    try:
+        while (keep_alive := handle_request(client)):
+            if not client.buffer:
+                idle_connections.park(client)
+                return
+        if keep_alive is None: # the connection is an event stream now
+            return
+        client.sock.close()
+    except Exception:
+        client.sock.close()
+        raise
+
+def worker_loop():
+    """A worker thread: handles the connections in the accept queue, one at a time"""
+    while True:
+        client = accept_queue.get()
+        worker_stats.count(busy=1)
+        try:
+            handle_client(client)
+        except Exception as e:
+            print(f"Error: handle_client error: {e}")
+        finally:
+            worker_stats.count(busy=-1, handled=1)
+
+def queue_connection(client):
+    """Queues a connection with a request to handle for the workers, or turns it away if the queue is full"""
+    try:
+        accept_queue.put_nowait(client)
+    except queue.Full:
+        worker_stats.count(rejected_queue_full=1)
+        reject_connection(client.sock)
+        return
+    worker_stats.count() # keeps queue_peak up to date
+
+def reject_connection(conn):
+    """Answers a connection 503 without reading its request, the accept queue has no room for it"""
+    try:
+        conn.settimeout(1)
+        conn.sendall(HTTPResponses.SERVICE_UNAVAILABLE)
+    except OSError:
+        pass
     finally:
         conn.close()
 
 def startup_server():
-    """Start up the server and continue to accept connection. Each new connection is assigned a new thread."""
+    """
+    Start up the server and continue to accept connections. Each new connection is queued for the pool of
+    WORKER_THREADS worker threads, or turned away with a 503 if ACCEPT_QUEUE_SIZE connections are waiting already.
+    """
     try:
         server_socket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
         server_socket.setsockopt(sock.SOL_SOCKET, sock.SO_REUSEADDR, 1)
@@ -461,10 +1544,16 @@ def startup_server():
         print(f"Webserver failed to start on {HOST}:{PORT}\nError: {e}")
         sys.exit(1)
 
+    static_assets.load()
+    for _ in range(WORKER_THREADS):
+        threading.Thread(target=worker_loop, daemon=True).start() #enable multi-threading
+    threading.Thread(target=idle_connections.run, daemon=True).start()
+    threading.Thread(target=event_streams.run, daemon=True).start()
+
     while True:
         conn, addr = server_socket.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True) #enable multi-threading
-        thread.start()
+        conn.settimeout(CLIENT_TIMEOUT)
+        queue_connection(BrowserConnection(conn, addr))
 
 #-------------------------------
 """